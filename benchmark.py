@@ -0,0 +1,76 @@
+#!/usr/bin/python2
+# vim: ts=4 : sts=4 : sw=4 : et :
+"""
+Compares the two ways of turning a starmap into database rows:  building
+the survey.System objects and flattening them, or parsing straight to
+survey.SystemRows.  Each is timed parsing alone, and parsing plus writing
+into a scratch database.
+"""
+
+import sys
+import os
+import time
+import tempfile
+import sqlite3
+import itertools
+
+import survey
+import data
+
+
+def object_rows(filename):
+    """The object path:  System/Body/Zone/Resource objects, then rows."""
+    return itertools.imap(survey.system_rows, survey.iter_starmap_file(filename))
+
+def direct_rows(filename):
+    """The direct path:  rows straight from the XML."""
+    return survey.iter_starmap_file_rows(filename)
+
+PATHS = [
+    ('objects', object_rows),
+    ('rows', direct_rows),
+    ]
+
+
+def time_parse(rows):
+    """Return the seconds taken to exhaust the iterable rows, and how many there were."""
+    start = time.time()
+    count = 0
+    for r in rows:
+        count += 1
+    return (time.time() - start, count)
+
+def time_ingest(rows):
+    """Return the seconds taken to write the iterable rows into a new scratch database."""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    con = sqlite3.connect(path)
+    con.row_factory = sqlite3.Row
+    data.set_pragmas(con)
+    try:
+        data.migrate(con)
+        start = time.time()
+        data.write_surveys(con.cursor(), rows)
+        con.commit()
+        return time.time() - start
+    finally:
+        con.close()
+        os.remove(path)
+
+
+def main(filename, repeats):
+    print "%-8s %10s %12s %14s" % ('path', 'parse', 'parse+write', 'systems/sec')
+    for name, path in PATHS:
+        parse = min([time_parse(path(filename)) for i in range(repeats)])
+        ingest = min([time_ingest(path(filename)) for i in range(repeats)])
+        print "%-8s %9.2fs %11.2fs %14.0f" % (name, parse[0], ingest, parse[1]/ingest)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or not os.path.isfile(sys.argv[1]):
+        print "usage: %s <starmap.xml> [repeats]" % sys.argv[0]
+        exit(1)
+    repeats = 3
+    if len(sys.argv) > 2:
+        repeats = int(sys.argv[2])
+    main(sys.argv[1], repeats)
@@ -0,0 +1,333 @@
+# vim: ts=4 : sts=4 : sw=4 : et :
+"""
+An in-memory copy of the resource_search table, held a column at a time.
+
+This is optional, and needs NumPy.  A search is answered by building a
+boolean mask over the columns and sorting what passes with numpy.lexsort,
+which beats SQLite's row-at-a-time join when a search matches much of the
+table.  data.search_resources decides when to use it; the results are the
+same rows in the same order either way.
+"""
+
+import re
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def available():
+    """Return whether NumPy is installed, which a ResourceTable needs."""
+    return numpy is not None
+
+
+#resource_search columns held as floats; NULL becomes NaN, which fails every
+#comparison just as NULL does in SQL
+NUMBER_COLUMNS = ('tl', 'quality', 'prevalence', 'zone', 'last_zone', 'resource_id', 'diameter',
+                  'sector_x', 'sector_y', 'sector_z', 'x', 'y', 'z', 'survey_id')
+#lookup table ids; NULL becomes -1, so it sorts first just as NULL does
+ID_COLUMNS = ('name_id', 'body_kind_id', 'orbit_zone_id')
+#text columns, held as codes into a TextColumn of their distinct values
+TEXT_COLUMNS = ('galaxy_name', 'sector_name', 'system_name', 'system_id', 'body_name')
+
+#the lookup tables that the id columns refer to
+LOOKUP_TABLES = ('resource_names', 'body_kinds', 'orbit_zones')
+
+#survey ids per IN (...) list when loading the rows of changed surveys
+LOAD_CHUNK = 500
+
+#SQLite's LIKE ignores case for ASCII letters only
+ASCII_LOWER = dict((ord(c), ord(c.lower())) for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+
+def like_test(pattern):
+    """Return a function that tests text against the SQL LIKE pattern the way SQLite does."""
+    if isinstance(pattern, str):
+        pattern = pattern.decode('utf-8')
+    parts = []
+    for c in pattern.translate(ASCII_LOWER):
+        if c == '%':
+            parts.append('.*')
+        elif c == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(c))
+    regex = re.compile(''.join(parts) + r'\Z', re.DOTALL)
+    def test(folded):
+        return folded is not None and regex.match(folded) is not None
+    return test
+
+
+class TextColumn:
+    """The distinct values of a text column, numbered in the order they were first seen."""
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+        #worked out again when a value is added
+        self.ranks = None
+        self.folded = None
+
+    def encode(self, values):
+        """Return an array of the codes of values, numbering any new ones."""
+        codes = []
+        for value in values:
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(value)
+                self.ranks = None
+                self.folded = None
+            codes.append(code)
+        return numpy.array(codes, dtype=numpy.int64)
+
+    def sort_ranks(self):
+        """Return an array giving the place of each code when the values are sorted as SQLite would."""
+        if self.ranks is None:
+            #code point order is the UTF-8 byte order that SQLite compares by,
+            #and NULL comes first
+            order = sorted(range(len(self.values)), key=lambda code: (self.values[code] is not None, self.values[code]))
+            self.ranks = numpy.empty(len(order), dtype=numpy.int64)
+            self.ranks[order] = numpy.arange(len(order))
+        return self.ranks
+
+    def matching(self, pattern):
+        """Return a boolean array of which codes have a value matching the SQL LIKE pattern."""
+        if self.folded is None:
+            self.folded = [value.translate(ASCII_LOWER) if value is not None else None for value in self.values]
+        test = like_test(pattern)
+        return numpy.array([test(value) for value in self.folded], dtype=bool)
+
+
+def integers(values):
+    """Return a list of the floats in array values as ints, or None where they are NaN."""
+    if numpy.isnan(values).any():
+        return [int(v) if v == v else None for v in values.tolist()]
+    return values.astype(numpy.int64).tolist()
+
+def floats(values):
+    """Return a list of the floats in array values, or None where they are NaN."""
+    return [v if v == v else None for v in values.tolist()]
+
+
+class ResourceTable:
+    """
+    The resource_search table of a database, held in NumPy arrays.
+
+    It reads through a connection of its own, which it closes with close().
+    Before each search it checks PRAGMA data_version, and if anything has
+    been committed since, it drops and reloads the rows of only those
+    surveys that were added, replaced or deleted.  The whole table is only
+    read again when most of the surveys have changed, or the names in
+    resource_names have been renumbered.
+    """
+    def __init__(self, con):
+        self.con = con
+        #transactions are begun by hand, so each refresh reads one snapshot
+        self.con.isolation_level = None
+        self.lock = threading.Lock()
+        self.data_version = None
+        self.reset()
+
+    def reset(self):
+        """Forget all the rows."""
+        self.columns = {}
+        for column in NUMBER_COLUMNS:
+            self.columns[column] = numpy.empty(0)
+        for column in ID_COLUMNS + TEXT_COLUMNS:
+            self.columns[column] = numpy.empty(0, dtype=numpy.int64)
+        self.text = dict((column, TextColumn()) for column in TEXT_COLUMNS)
+        #id -> name for each lookup table
+        self.lookups = dict((table, {}) for table in LOOKUP_TABLES)
+        #survey id -> (fingerprint, stored_date) of the surveys whose rows are held
+        self.surveys = {}
+        self.zone_numbers = numpy.empty(0)
+
+    def close(self):
+        with self.lock:
+            self.con.close()
+
+    def __len__(self):
+        return len(self.columns['survey_id'])
+
+    def refresh(self):
+        """Bring the rows up to date with the database, if anything has been committed since the last time."""
+        version = self.con.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.data_version:
+            return
+        self.con.execute("BEGIN")
+        try:
+            lookups = {}
+            for table in LOOKUP_TABLES:
+                lookups[table] = dict(self.con.execute("SELECT id, name FROM %s" % table).fetchall())
+            surveys = {}
+            for row in self.con.execute("SELECT id, fingerprint, stored_date FROM surveys"):
+                surveys[row[0]] = (row[1], row[2])
+
+            gone = [survey_id for survey_id, key in self.surveys.iteritems() if surveys.get(survey_id) != key]
+            new = [survey_id for survey_id, key in surveys.iteritems() if self.surveys.get(survey_id) != key]
+            if len(self) == 0 or len(gone) + len(new) > len(surveys) / 2 or not self.renumber(lookups):
+                self.reset()
+                self.load()
+            else:
+                if len(gone) > 0:
+                    self.drop_surveys(gone)
+                for i in range(0, len(new), LOAD_CHUNK):
+                    chunk = new[i:i+LOAD_CHUNK]
+                    self.load("WHERE survey_id IN (?%s)" % (",?"*(len(chunk)-1)), chunk)
+
+            self.zone_numbers = numpy.array([row[0] for row in self.con.execute("SELECT zone FROM zone_numbers")], dtype=float)
+            self.lookups = lookups
+            self.surveys = surveys
+            self.data_version = version
+        except:
+            #start from scratch next time
+            self.reset()
+            self.data_version = None
+            raise
+        finally:
+            self.con.execute("COMMIT")
+
+    def load(self, where="", parameters=()):
+        """Add the rows of resource_search picked out by the where clause."""
+        names = NUMBER_COLUMNS + ID_COLUMNS + TEXT_COLUMNS
+        rows = self.con.execute("SELECT %s FROM resource_search %s" % (", ".join(names), where), parameters).fetchall()
+        if len(rows) == 0:
+            return
+        for column, values in zip(names, zip(*rows)):
+            if column in NUMBER_COLUMNS:
+                array = numpy.array(values, dtype=float)
+            elif column in ID_COLUMNS:
+                array = numpy.array([-1 if v is None else v for v in values], dtype=numpy.int64)
+            else:
+                array = self.text[column].encode(values)
+            self.columns[column] = numpy.concatenate((self.columns[column], array))
+
+    def renumber(self, lookups):
+        """
+        Give the id columns the ids that their names have in lookups, a dict of id -> name per lookup table.
+
+        A new resource name renumbers resource_names to keep it in
+        alphabetical order.  Returns False if a name has gone altogether.
+        """
+        for table, column in zip(LOOKUP_TABLES, ID_COLUMNS):
+            old = self.lookups[table]
+            if all([lookups[table].get(id) == name for id, name in old.iteritems()]):
+                continue
+            ids = dict((name, id) for id, name in lookups[table].iteritems())
+            #indexed by old id+1, since NULL is -1
+            new_ids = numpy.full(max(old.keys()) + 2, -1, dtype=numpy.int64)
+            for id, name in old.iteritems():
+                if name not in ids:
+                    return False
+                new_ids[id + 1] = ids[name]
+            self.columns[column] = new_ids[self.columns[column] + 1]
+        return True
+
+    def drop_surveys(self, survey_ids):
+        """Drop the rows of the surveys in the list survey_ids."""
+        keep = ~numpy.in1d(self.columns['survey_id'], numpy.array(survey_ids, dtype=float))
+        for column in self.columns:
+            self.columns[column] = self.columns[column][keep]
+
+    def select(self, matches, likes, bounds, centers, max_distance):
+        """
+        Return the rows of a search, as data.search_resources does.
+
+        matches is a list of (id column, list of the ids it may hold), likes
+        a list of (text column, LIKE pattern), and bounds a list of (number
+        column, '>=' or '<=', value).  centers is a list of (x, y or z,
+        value); the squared distances from them are summed into the last
+        value of each row, and if max_distance is not None, rows farther
+        than it (squared) are left out.
+        """
+        with self.lock:
+            self.refresh()
+            columns = self.columns
+
+            mask = numpy.ones(len(self), dtype=bool)
+            for column, ids in matches:
+                #a table of which ids pass, indexed by id+1 since NULL is -1
+                size = max(ids + [-1]) + 2
+                if len(columns[column]) > 0:
+                    #max(initial=) would do this, but needs NumPy 1.15
+                    size = max(size, columns[column].max() + 2)
+                allowed = numpy.zeros(size, dtype=bool)
+                allowed[numpy.array(ids, dtype=numpy.int64) + 1] = True
+                mask &= allowed[columns[column] + 1]
+            for column, pattern in likes:
+                mask &= self.text[column].matching(pattern)[columns[column]]
+            for column, op, value in bounds:
+                if op == '>=':
+                    mask &= columns[column] >= value
+                else:
+                    mask &= columns[column] <= value
+            index = numpy.flatnonzero(mask)
+
+            distance = None
+            for axis, center in centers:
+                #summed in the same order as the SQL, so the values come out the same
+                term = (columns[axis][index] - center) * (columns[axis][index] - center)
+                if distance is None:
+                    distance = term
+                else:
+                    distance = distance + term
+            if distance is not None and max_distance is not None:
+                near = distance <= max_distance
+                index = index[near]
+                distance = distance[near]
+
+            #body-wide rows stand for each zone from zone to last_zone, as
+            #the join with zone_numbers has them
+            start = columns['zone'][index]
+            counts = columns['last_zone'][index] - start + 1
+            counts[~(counts > 0)] = 0
+            counts = counts.astype(numpy.int64)
+            rows = numpy.repeat(index, counts)
+            zone = numpy.repeat(start, counts) + (numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(counts) - counts, counts))
+            if distance is not None:
+                distance = numpy.repeat(distance, counts)
+            keep = numpy.in1d(zone, self.zone_numbers)
+            rows = rows[keep]
+            zone = zone[keep]
+            if distance is not None:
+                distance = distance[keep]
+
+            #the ORDER BY of the SQL, then the order of the resource_search primary key
+            order = numpy.lexsort((columns['resource_id'][rows],
+                                   columns['zone'][rows],
+                                   zone,
+                                   self.text['body_name'].sort_ranks()[columns['body_name'][rows]],
+                                   self.text['system_name'].sort_ranks()[columns['system_name'][rows]],
+                                   self.text['sector_name'].sort_ranks()[columns['sector_name'][rows]],
+                                   -columns['prevalence'][rows],
+                                   -columns['quality'][rows],
+                                   columns['name_id'][rows]))
+            rows = rows[order]
+            zone = zone[order]
+
+            def lookup(table, column):
+                names = self.lookups[table]
+                return [names.get(id) for id in columns[column][rows].tolist()]
+            def text(column):
+                values = self.text[column].values
+                return [values[code] for code in columns[column][rows].tolist()]
+            if distance is not None:
+                distances = floats(distance[order])
+            else:
+                distances = [None] * len(rows)
+            return zip(lookup('resource_names', 'name_id'),
+                       integers(columns['tl'][rows]),
+                       integers(columns['quality'][rows]),
+                       integers(columns['prevalence'][rows]),
+                       floats(columns['diameter'][rows]),
+                       lookup('body_kinds', 'body_kind_id'),
+                       lookup('orbit_zones', 'orbit_zone_id'),
+                       integers(zone),
+                       text('galaxy_name'),
+                       text('sector_name'),
+                       text('system_name'),
+                       text('system_id'),
+                       text('body_name'),
+                       distances)
@@ -4,8 +4,17 @@ import wx
 import survey
 import sqlite3
 import datetime, time
+import math
 import os.path
+import zlib
+import hashlib
+import itertools
+import collections
+import multiprocessing
+import threading
+import atexit
 import tabulation
+import columnar
 
 def adapt_datetime(ts):
     """For use with sqlite3.register_adapter so that datetime is used correctly."""
@@ -23,36 +32,360 @@ def get_last_starmap_path():
 def set_last_starmap_path(last_path):
     wx.Config.Get().Write('/starmaps/last', last_path)
 
+#the database path from the config, read the first time it is needed
+database_path = None
+
 def get_database_path():
-    database_path = 'database.sqlite3'
-    if wx.Config.Get().HasEntry('/database/name'):
-        database_path = wx.Config.Get().Read('/database/name')
+    global database_path
+    if database_path is None:
+        database_path = 'database.sqlite3'
+        if wx.Config.Get().HasEntry('/database/name'):
+            database_path = wx.Config.Get().Read('/database/name')
     return database_path
 
-def set_database_path(database_path):
-    wx.Config.Get().Write('/database/name', database_path)
+def set_database_path(path):
+    """Switch to the database at path, and remember it in the config."""
+    global database_path
+    wx.Config.Get().Write('/database/name', path)
+    database_path = path
+    close_connections()
 
-def get_con():
-    """Get connection to database."""
-    con = sqlite3.connect(get_database_path())
+#database paths whose schema has already been brought up to date
+migrated_paths = set()
+
+def connect(path=None, factory=sqlite3.Connection, settings=None):
+    """
+    Get a new connection to database, or the one at path, without checking the schema.
+
+    settings are the connection settings to use, as get_database_settings
+    gives them; they are read from the config if not given.
+    """
+    if path is None:
+        path = get_database_path()
+    con = sqlite3.connect(path, factory=factory,
+                          check_same_thread=False, cached_statements=CACHED_STATEMENTS)
     con.row_factory = sqlite3.Row
+    set_pragmas(con, settings)
     return con
 
 
+#prepared statements kept by each connection; the searches are built from
+#their parameters, so there are many different ones
+CACHED_STATEMENTS = 200
+
+#idle reader connections kept open for the next get_con
+POOL_SIZE = 4
+
+class PooledConnection(sqlite3.Connection):
+    """A connection that goes back to its ConnectionPool when closed, instead of closing."""
+    pool = None
+    borrowed = False
+    #what PRAGMA data_version said when it was last borrowed
+    data_version = None
+
+    def close(self):
+        if self.pool is None:
+            sqlite3.Connection.close(self)
+        elif self.borrowed:
+            self.borrowed = False
+            self.pool.give_back(self)
+
+
+class ConnectionPool:
+    """
+    The open connections to one database.
+
+    There is a single writer connection, which one thread at a time can
+    borrow, and any number of readers, of which up to POOL_SIZE are kept
+    open while idle.  Readers can't write, and thanks to WAL mode they
+    don't wait for the writer.  Closing a borrowed connection rolls back
+    anything left uncommitted and gives it back.
+
+    Once the pool is closed, connections still borrowed from it are really
+    closed when they are given back.
+
+    Connections are opened with settings, as get_database_settings gives
+    them, since they can be opened from any thread but only the main one
+    may read the config.
+    """
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.idle = []
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.closed = False
+
+    def borrow_reader(self):
+        con = None
+        with self.lock:
+            if len(self.idle) > 0:
+                con = self.idle.pop()
+        if con is None:
+            con = connect(self.path, PooledConnection, self.settings)
+            con.execute("PRAGMA query_only = ON")
+            con.pool = self
+        #this changes whenever another connection commits, including one in
+        #another process, so it also catches writes made behind our back
+        version = con.execute("PRAGMA data_version").fetchone()[0]
+        if version != con.data_version:
+            con.data_version = version
+            search_cache.invalidate()
+        con.borrowed = True
+        return con
+
+    def borrow_writer(self):
+        """Borrow the writer, waiting for whichever thread has it to give it back."""
+        self.writer_lock.acquire()
+        try:
+            if self.writer is None:
+                self.writer = connect(self.path, PooledConnection, self.settings)
+                self.writer.pool = self
+        except:
+            self.writer_lock.release()
+            raise
+        self.writer.borrowed = True
+        return self.writer
+
+    def give_back(self, con):
+        con.rollback()
+        con.set_progress_handler(None, 0)
+        if con is self.writer:
+            #whatever it wrote is committed by now
+            search_cache.invalidate()
+            if self.closed:
+                self.writer = None
+                sqlite3.Connection.close(con)
+            self.writer_lock.release()
+            return
+        with self.lock:
+            if not self.closed and len(self.idle) < POOL_SIZE:
+                self.idle.append(con)
+                return
+        sqlite3.Connection.close(con)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+        for con in idle:
+            sqlite3.Connection.close(con)
+        if self.writer_lock.acquire(False):
+            if self.writer is not None:
+                sqlite3.Connection.close(self.writer)
+                self.writer = None
+            self.writer_lock.release()
+
+
+#the ConnectionPool for the current database
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Return the ConnectionPool for the current database, opening it if needed.
+
+    Opening it reads the config, so the GUI does that on the main thread,
+    when it loads the search choices.
+    """
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ConnectionPool(get_database_path(), get_database_settings())
+        return pool
+
+def close_connections():
+    """Close the connections to the current database; the next call for one opens it again."""
+    global pool
+    unload_resource_table()
+    search_cache.invalidate()
+    with pool_lock:
+        old = pool
+        pool = None
+    if old is not None:
+        old.close()
+atexit.register(close_connections)
+
+
+#the columnar.ResourceTable that searches are answered from, once loaded
+resource_table = None
+resource_table_lock = threading.Lock()
+
+def get_columnar_enabled():
+    """Return whether searches are to be answered from a columnar.ResourceTable, which needs NumPy."""
+    enabled = False
+    if wx.Config.Get().HasEntry('/search/columnar'):
+        enabled = wx.Config.Get().ReadInt('/search/columnar') != 0
+    return enabled and columnar.available()
+
+def set_columnar_enabled(enabled):
+    """Remember whether searches are to use a columnar.ResourceTable, unloading it if not."""
+    wx.Config.Get().WriteInt('/search/columnar', int(enabled))
+    if not enabled:
+        unload_resource_table()
+
+def load_resource_table():
+    """
+    Load the columnar.ResourceTable for the current database if searches are to use one, and return it.
+
+    This reads all of resource_search, which takes a few seconds on a big
+    database, so the GUI does it in the background; searches use SQLite
+    until it is done.  Returns None if searches aren't to use one.
+    """
+    global resource_table
+    if not get_columnar_enabled():
+        return None
+    with resource_table_lock:
+        if resource_table is None:
+            #bring the schema up to date first
+            get_con().close()
+            connections = get_pool()
+            con = connect(connections.path, settings=connections.settings)
+            con.execute("PRAGMA query_only = ON")
+            table = columnar.ResourceTable(con)
+            table.refresh()
+            resource_table = table
+        return resource_table
+
+def unload_resource_table():
+    """Drop the columnar.ResourceTable, if one is loaded, so searches go back to SQLite."""
+    global resource_table
+    with resource_table_lock:
+        table = resource_table
+        resource_table = None
+    if table is not None:
+        table.close()
+
+#connection settings, and their defaults; each can be overridden by an entry
+#of the same name under /database/ in the config
+DATABASE_SETTINGS = {
+    #OFF, NORMAL or FULL; NORMAL can lose the last commits in a power cut, but
+    #never corrupts the database
+    'synchronous': 'NORMAL',
+    #KiB of page cache per connection
+    'cache_size': 64*1024,
+    #MiB of the database file to read through memory mapping, or 0 not to
+    'mmap_size': 256,
+    #pages the WAL may reach before a commit copies it back into the database
+    'checkpoint_pages': 1000,
+    }
+
+#bytes the WAL file is cut back to whenever it is emptied
+WAL_SIZE_LIMIT = 64*1024*1024
+
+def get_database_setting(name):
+    """Return the connection setting called name from the config, or its default."""
+    default = DATABASE_SETTINGS[name]
+    key = '/database/' + name
+    if not wx.Config.Get().HasEntry(key):
+        return default
+    if isinstance(default, int):
+        return wx.Config.Get().ReadInt(key)
+    return wx.Config.Get().Read(key)
+
+def get_database_settings():
+    """Return a dictionary of every connection setting, from the config or their defaults."""
+    return dict([(name, get_database_setting(name)) for name in DATABASE_SETTINGS])
+
+def set_pragmas(con, settings=None):
+    """
+    Set the options that every connection to the database needs.
+
+    settings are as get_database_settings gives them, and are read from
+    the config if not given.
+    """
+    if settings is None:
+        settings = get_database_settings()
+    #readers keep their snapshot while a writer works, instead of being
+    #locked out; the mode is stored in the file, so this only has work to do once
+    if con.execute("PRAGMA journal_mode").fetchone()[0] != 'wal':
+        con.execute("PRAGMA journal_mode = WAL")
+    synchronous = settings['synchronous'].upper()
+    if synchronous not in ('OFF', 'NORMAL', 'FULL'):
+        synchronous = DATABASE_SETTINGS['synchronous']
+    con.execute("PRAGMA synchronous = %s" % synchronous)
+    #negative means KiB rather than pages
+    con.execute("PRAGMA cache_size = %d" % -settings['cache_size'])
+    con.execute("PRAGMA mmap_size = %d" % (settings['mmap_size']*1024*1024))
+    con.execute("PRAGMA wal_autocheckpoint = %d" % settings['checkpoint_pages'])
+    con.execute("PRAGMA journal_size_limit = %d" % WAL_SIZE_LIMIT)
+    #a survey's bodies, resources and wormholes are deleted along with it
+    con.execute("PRAGMA foreign_keys = ON")
+    #replacing a survey has to fire its delete triggers like deleting it does
+    con.execute("PRAGMA recursive_triggers = ON")
+
+def checkpoint(con):
+    """
+    Copy everything in the WAL back into the database behind con, and empty the WAL file.
+
+    The automatic checkpoints after each commit give up on whatever a
+    search is still reading, and the WAL grows as long as they keep doing
+    so.  Ingests run this after each file they commit, which keeps the WAL
+    to about one file's worth.  Searches still reading are waited for as
+    long as the connection's timeout allows, and then the WAL is left as it
+    is until the next time.
+    """
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def get_con():
+    """
+    Borrow a read-only connection to the database; close() gives it back.
+
+    The schema is brought up to date the first time the database is used.
+    """
+    connections = get_pool()
+    if connections.path not in migrated_paths:
+        create_tables()
+    return connections.borrow_reader()
+
+def get_writer():
+    """
+    Borrow the connection to the database that writes; close() gives it back.
+
+    Only one thread has it at a time, so it must be given back before the
+    same thread asks for it again.
+    """
+    connections = get_pool()
+    if connections.path not in migrated_paths:
+        create_tables()
+    return connections.borrow_writer()
+
+
 def drop_tables():
     """Drop all tables if they exist."""
 
-    con = get_con()
-    for t in [ 'raws', 'surveys', 'wormholes', 'bodies', 'resources' ]:
-        con.execute("drop table if exists %s" % t)
-    con.commit()
-    con.close()
+    con = get_pool().borrow_writer()
+    #dropping a table that others refer to would delete their rows first
+    con.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for t in [ 'raws', 'surveys', 'wormholes', 'bodies', 'resources', 'survey_locations', 'body_names', 'survey_names', 'resource_search',
+                   'checkpoints', 'resource_names', 'body_kinds', 'orbit_zones', 'zone_numbers' ]:
+            con.execute("drop table if exists %s" % t)
+        con.execute("PRAGMA user_version = 0")
+        con.commit()
+    finally:
+        con.rollback()
+        con.execute("PRAGMA foreign_keys = ON")
+        con.close()
+    migrated_paths.discard(get_database_path())
 
 
 def create_tables():
-    """Create the tables in the database if needed."""
+    """Create the tables in the database if needed, and bring the schema up to date."""
 
-    con = get_con()
+    connections = get_pool()
+    con = connections.borrow_writer()
+    try:
+        migrate(con)
+    finally:
+        con.close()
+    migrated_paths.add(connections.path)
+
+
+def create_base_tables(con):
+    """Schema version 1:  the original tables."""
 
     con.execute("""create table if not exists raws (
                     filename    text,
@@ -104,111 +437,1105 @@ def create_tables():
                     survey_id   integer
                     )""")
 
+
+def add_fingerprint_column(con):
+    """Schema version 2:  the fingerprint of each survey's XML."""
+
+    columns = [row['name'] for row in con.execute("PRAGMA table_info(surveys)")]
+    if 'fingerprint' not in columns:
+        con.execute("alter table surveys add column fingerprint text")
+
+
+def add_indexes(con):
+    """Schema version 3:  secondary indexes for the lookups and joins."""
+
+    con.execute("create index if not exists resources_survey_id on resources (survey_id)")
+    con.execute("create index if not exists resources_body_id on resources (body_id)")
+    con.execute("create index if not exists resources_name_tl_quality on resources (name collate nocase, tl, quality)")
+    con.execute("create index if not exists bodies_survey_id on bodies (survey_id)")
+    con.execute("create index if not exists wormholes_survey_id on wormholes (survey_id)")
+    con.execute("create index if not exists surveys_system_id on surveys (system_id)")
+
+
+def add_location_index(con):
+    """Schema version 4:  an R*Tree of the universal coordinates of each survey, in parsecs."""
+
+    try:
+        con.execute("""create virtual table if not exists survey_locations using rtree (
+                        id,
+                        min_x, max_x,
+                        min_y, max_y,
+                        min_z, max_z
+                        )""")
+    except sqlite3.OperationalError:
+        #this sqlite was built without the R*Tree module; radius searches will just scan
+        return
+
+    con.execute("""create trigger if not exists survey_locations_insert after insert on surveys
+                   begin
+                       insert into survey_locations values (new.ROWID,
+                           new.sector_x*10 + new.system_x, new.sector_x*10 + new.system_x,
+                           new.sector_y*10 + new.system_y, new.sector_y*10 + new.system_y,
+                           new.sector_z*10 + new.system_z, new.sector_z*10 + new.system_z);
+                   end""")
+    con.execute("""create trigger if not exists survey_locations_delete after delete on surveys
+                   begin
+                       delete from survey_locations where id = old.ROWID;
+                   end""")
+    con.execute("""insert or replace into survey_locations
+                   select ROWID,
+                          sector_x*10 + system_x, sector_x*10 + system_x,
+                          sector_y*10 + system_y, sector_y*10 + system_y,
+                          sector_z*10 + system_z, sector_z*10 + system_z
+                   from surveys""")
+
+
+def add_name_indexes(con):
+    """Schema version 5:  trigram full-text indexes of the body, system and sector names."""
+
+    try:
+        con.execute("""create virtual table if not exists body_names using fts5 (
+                        name,
+                        content='bodies', tokenize='trigram'
+                        )""")
+        con.execute("""create virtual table if not exists survey_names using fts5 (
+                        system_name, sector_name,
+                        content='surveys', tokenize='trigram'
+                        )""")
+    except sqlite3.OperationalError:
+        #this sqlite is too old or was built without FTS5; substring searches will just scan
+        return
+
+    con.execute("""create trigger if not exists body_names_insert after insert on bodies
+                   begin
+                       insert into body_names (rowid, name) values (new.ROWID, new.name);
+                   end""")
+    con.execute("""create trigger if not exists body_names_delete after delete on bodies
+                   begin
+                       insert into body_names (body_names, rowid, name) values ('delete', old.ROWID, old.name);
+                   end""")
+    con.execute("""create trigger if not exists survey_names_insert after insert on surveys
+                   begin
+                       insert into survey_names (rowid, system_name, sector_name) values (new.ROWID, new.system_name, new.sector_name);
+                   end""")
+    con.execute("""create trigger if not exists survey_names_delete after delete on surveys
+                   begin
+                       insert into survey_names (survey_names, rowid, system_name, sector_name) values ('delete', old.ROWID, old.system_name, old.sector_name);
+                   end""")
+    con.execute("insert into body_names (body_names) values ('rebuild')")
+    con.execute("insert into survey_names (survey_names) values ('rebuild')")
+
+
+#the columns of resource_search as schema version 6 created it, and what they were filled from;
+#its primary key can't hold NULLs, so missing names are stored as ''
+TEXT_SEARCH_COLUMNS = (
+    ('name',        "coalesce(resources.name, '')"),
+    ('quality',     'resources.quality'),
+    ('prevalence',  'resources.prevalence'),
+    ('sector_name', "coalesce(surveys.sector_name, '')"),
+    ('system_name', "coalesce(surveys.system_name, '')"),
+    ('body_name',   "coalesce(bodies.name, '')"),
+    ('zone',        'coalesce(resources.zone, 0)'),
+    ('resource_id', 'resources.ROWID'),
+    ('tl',          'resources.tl'),
+    ('diameter',    'bodies.diameter'),
+    ('body_kind',   'bodies.body_kind'),
+    ('orbit_zone',  'bodies.orbit_zone'),
+    ('galaxy_name', 'surveys.galaxy_name'),
+    ('system_id',   'surveys.system_id'),
+    ('sector_x',    'surveys.sector_x'),
+    ('sector_y',    'surveys.sector_y'),
+    ('sector_z',    'surveys.sector_z'),
+    ('x',           'surveys.sector_x*10 + surveys.system_x'),
+    ('y',           'surveys.sector_y*10 + surveys.system_y'),
+    ('z',           'surveys.sector_z*10 + surveys.system_z'),
+    ('body_id',     'bodies.ROWID'),
+    ('survey_id',   'surveys.ROWID'),
+    )
+
+#the columns of resource_search, and what they are filled from; as above,
+#the ones in its primary key are never NULL
+SEARCH_COLUMNS = (
+    ('name_id',     'resources.name_id'),
+    ('quality',     'resources.quality'),
+    ('prevalence',  'resources.prevalence'),
+    ('sector_name', "coalesce(surveys.sector_name, '')"),
+    ('system_name', "coalesce(surveys.system_name, '')"),
+    ('body_name',   "coalesce(bodies.name, '')"),
+    ('zone',        'coalesce(resources.zone, 0)'),
+    ('resource_id', 'resources.ROWID'),
+    ('tl',          'resources.tl'),
+    ('diameter',    'bodies.diameter'),
+    ('body_kind_id',    'bodies.body_kind_id'),
+    ('orbit_zone_id',   'bodies.orbit_zone_id'),
+    ('galaxy_name', 'surveys.galaxy_name'),
+    ('system_id',   'surveys.system_id'),
+    ('sector_x',    'surveys.sector_x'),
+    ('sector_y',    'surveys.sector_y'),
+    ('sector_z',    'surveys.sector_z'),
+    ('x',           'surveys.sector_x*10 + surveys.system_x'),
+    ('y',           'surveys.sector_y*10 + surveys.system_y'),
+    ('z',           'surveys.sector_z*10 + surveys.system_z'),
+    ('body_id',     'bodies.ROWID'),
+    ('survey_id',   'surveys.ROWID'),
+    ('last_zone',   'coalesce(resources.zone, bodies.num_zones - 1)'),
+    )
+
+def search_select(source='resources', columns=SEARCH_COLUMNS):
+    """
+    Return the SELECT that builds resource_search rows from the resources in source.
+
+    Passing 'new' gives the SELECT for a single row inside a trigger.
+    """
+    columns = [c[1].replace('resources.', source + '.') for c in columns]
+    query = "SELECT %s FROM " % ", ".join(columns)
+    if source == 'resources':
+        query += "resources, "
+    query += "bodies, surveys WHERE bodies.ROWID = %s.body_id AND surveys.ROWID = %s.survey_id" % (source, source)
+    return query
+
+
+def add_search_table(con):
+    """
+    Schema version 6:  resource_search, a pre-joined copy of everything find_resources shows.
+
+    It is stored in the order find_resources sorts in, so that sorted scans
+    read it sequentially and the first rows of any search come back at once.
+    """
+
+    con.execute("""create table if not exists resource_search (
+                    name        text collate nocase,
+                    quality     integer,
+                    prevalence  integer,
+                    sector_name text,
+                    system_name text,
+                    body_name   text,
+                    zone        integer,
+                    resource_id integer,
+                    tl          integer,
+                    diameter    text,
+                    body_kind   text,
+                    orbit_zone  text,
+                    galaxy_name text,
+                    system_id   text,
+                    sector_x    integer,
+                    sector_y    integer,
+                    sector_z    integer,
+                    x           real,
+                    y           real,
+                    z           real,
+                    body_id     integer,
+                    survey_id   integer,
+                    primary key (name, quality desc, prevalence desc,
+                                 sector_name, system_name, body_name, zone, resource_id)
+                    ) without rowid""")
+    con.execute("create index if not exists resource_search_body_id on resource_search (body_id)")
+    con.execute("create index if not exists resource_search_survey_id on resource_search (survey_id)")
+
+    con.execute("""create trigger if not exists resource_search_insert after insert on resources
+                   begin
+                       insert into resource_search %s;
+                   end""" % search_select('new', TEXT_SEARCH_COLUMNS))
+    con.execute("""create trigger if not exists resource_search_delete after delete on surveys
+                   begin
+                       delete from resource_search where survey_id = old.ROWID;
+                   end""")
+
+    con.execute("insert or replace into resource_search %s" % search_select(columns=TEXT_SEARCH_COLUMNS))
+
+
+def add_raw_codec_column(con):
+    """Schema version 7:  how each raw file is compressed, or NULL if it isn't."""
+
+    columns = [row['name'] for row in con.execute("PRAGMA table_info(raws)")]
+    if 'codec' not in columns:
+        con.execute("alter table raws add column codec text")
+
+
+def add_raw_hash_column(con):
+    """
+    Schema version 8:  raws are keyed by the SHA-1 of their contents.
+
+    When the same file was stored more than once, only the first copy is kept.
+    """
+
+    columns = [row['name'] for row in con.execute("PRAGMA table_info(raws)")]
+    if 'hash' not in columns:
+        con.execute("alter table raws add column hash text")
+    if 'added_date' not in columns:
+        con.execute("alter table raws add column added_date date")
+
+    #hash the old rows one at a time, since each holds a whole file
+    cur = con.cursor()
+    cur.execute("SELECT ROWID FROM raws WHERE hash IS NULL ORDER BY ROWID")
+    seen = set()
+    for raw_id in [row[0] for row in cur.fetchall()]:
+        cur.execute("SELECT data, codec FROM raws WHERE ROWID = ?", (raw_id,))
+        row = cur.fetchone()
+        digest = raw_digest(survey.open_starmap_buffer(row[0], row[1]))
+        cur.execute("SELECT 1 FROM raws WHERE hash = ?", (digest,))
+        if digest in seen or cur.fetchone() is not None:
+            cur.execute("DELETE FROM raws WHERE ROWID = ?", (raw_id,))
+        else:
+            cur.execute("UPDATE raws SET hash = ? WHERE ROWID = ?", (digest, raw_id))
+            seen.add(digest)
+
+    con.execute("create unique index if not exists raws_hash on raws (hash)")
+
+
+def add_checkpoints_table(con):
+    """Schema version 9:  how far an interrupted long-running task got."""
+
+    con.execute("""create table if not exists checkpoints (
+                    task        text primary key,
+                    raw_id      integer
+                    )""")
+
+
+#the values the lookup tables start out with, in the order the GUI lists them;
+#resource names are kept in alphabetical order, see sort_resource_names
+RESOURCE_NAMES = [
+    'Air', 'Animal Carcass', 'Antiflux Particles', 'Beans', 'Bolite',
+    'Borexino Precipitate', 'Cheese', 'Coal', 'Cryozine', 'Crystals',
+    'Eggs', 'Eludium', 'Fertilizer', 'Fish', 'Fruit',
+    'Gems', 'Grain', 'Grapes', 'Herbs', 'Hops',
+    'Hydrogen', 'Ice', 'Ioplasma', 'Log', 'Lumenite',
+    'Magmex', 'Milk', 'Minerals', 'Myrathane', 'Natural Gas',
+    'Nuts', 'Oil', 'Ore', 'Phlogiston', 'Plant Fiber',
+    'Polytaride', 'Radioactives', 'Spices', 'Stone', 'Sunlight',
+    'Type A Preons', 'Type B Preons', 'Type F Preons', 'Type G Preons', 'Type K Preons',
+    'Type M Preons', 'Type O Preons', 'Vegetable', 'Vegetation Density', 'Vulcanite',
+    'Water in the Environment',
+    ]
+BODY_KINDS = [
+    'Ringworld',
+    'Planet',
+    'Large Moon',
+    'Moon',
+    'Ring',
+    'Gas Giant',
+    'Star',
+    ]
+ORBIT_ZONES = [
+    'Inferno Zone',
+    'Inner Zone',
+    'Habitable Zone',
+    'Outer Zone',
+    'Frigid Zone',
+    ]
+
+def create_lookup_tables(con):
+    """Create the resource_names, body_kinds and orbit_zones lookup tables if needed, and seed them."""
+
+    for table, seed in (('resource_names', RESOURCE_NAMES), ('body_kinds', BODY_KINDS), ('orbit_zones', ORBIT_ZONES)):
+        con.execute("""create table if not exists %s (
+                        id          integer primary key,
+                        name        text unique
+                        )""" % table)
+        con.executemany("insert or ignore into %s (name) values (?)" % table, [(name,) for name in seed])
+
+
+def create_search_table(con):
+    """
+    Create resource_search, its indexes and triggers, and fill it.
+
+    Each row covers the zones from zone to last_zone, so the global
+    resources of a body are held once, like in resources;  search_resources
+    expands them into one row per zone.
+    """
+
+    con.execute("""create table if not exists resource_search (
+                    name_id     integer,
+                    quality     integer,
+                    prevalence  integer,
+                    sector_name text,
+                    system_name text,
+                    body_name   text,
+                    zone        integer,
+                    resource_id integer,
+                    tl          integer,
+                    diameter    real,
+                    body_kind_id    integer,
+                    orbit_zone_id   integer,
+                    galaxy_name text,
+                    system_id   text,
+                    sector_x    integer,
+                    sector_y    integer,
+                    sector_z    integer,
+                    x           real,
+                    y           real,
+                    z           real,
+                    body_id     integer,
+                    survey_id   integer,
+                    last_zone   integer,
+                    primary key (name_id, quality desc, prevalence desc,
+                                 sector_name, system_name, body_name, zone, resource_id)
+                    ) without rowid""")
+    con.execute("create index if not exists resource_search_body_id on resource_search (body_id)")
+    con.execute("create index if not exists resource_search_survey_id on resource_search (survey_id)")
+
+    con.execute("""create trigger if not exists resource_search_insert after insert on resources
+                   begin
+                       insert into resource_search %s;
+                   end""" % search_select('new'))
+    con.execute("""create trigger if not exists resource_search_delete after delete on surveys
+                   begin
+                       delete from resource_search where survey_id = old.ROWID;
+                   end""")
+
+    con.execute("insert or replace into resource_search %s" % search_select())
+
+
+def encode_names(con):
+    """
+    Schema version 10:  resource names, body kinds and orbit zones are stored as ids into lookup tables.
+
+    resources, bodies and resource_search are rebuilt, keeping their ROWIDs.
+    """
+
+    columns = [row['name'] for row in con.execute("PRAGMA table_info(resources)")]
+    if 'name_id' in columns:
+        return
+
+    #resource_search refers to the tables being rebuilt, so it goes first
+    con.execute("drop trigger if exists resource_search_insert")
+    con.execute("drop trigger if exists resource_search_delete")
+    con.execute("drop table if exists resource_search")
+
+    create_lookup_tables(con)
+    #a missing resource name becomes '', since resource_search can't hold a NULL name_id
+    con.execute("insert or ignore into resource_names (name) select distinct coalesce(name, '') from resources")
+    con.execute("insert or ignore into body_kinds (name) select distinct body_kind from bodies where body_kind is not null")
+    con.execute("insert or ignore into orbit_zones (name) select distinct orbit_zone from bodies where orbit_zone is not null")
+    #nothing refers to the ids yet
+    sort_resource_names(con.cursor(), ())
+
+    con.execute("""create table resources_encoded (
+                    name_id     integer,
+                    quality     integer,
+                    prevalence  integer,
+                    tl          integer,
+                    zone        integer,
+                    body_id     integer,
+                    survey_id   integer
+                    )""")
+    con.execute("""insert into resources_encoded (ROWID, name_id, quality, prevalence, tl, zone, body_id, survey_id)
+                   select resources.ROWID, resource_names.id, quality, prevalence, tl, zone, body_id, survey_id
+                   from resources left join resource_names on resource_names.name = coalesce(resources.name, '')""")
+    con.execute("drop table resources")
+    con.execute("alter table resources_encoded rename to resources")
+    con.execute("create index if not exists resources_survey_id on resources (survey_id)")
+    con.execute("create index if not exists resources_body_id on resources (body_id)")
+    con.execute("create index if not exists resources_name_tl_quality on resources (name_id, tl, quality)")
+
+    con.execute("""create table bodies_encoded (
+                    name        text,
+                    body_kind_id    integer,
+                    star_type   text,
+                    spectral_class  text,
+                    star_size   text,
+                    diameter    text,
+                    orbits      text,
+                    orbit_zone_id   integer,
+                    num_zones   integer,
+                    survey_id   integer
+                    )""")
+    con.execute("""insert into bodies_encoded (ROWID, name, body_kind_id, star_type, spectral_class, star_size,
+                                               diameter, orbits, orbit_zone_id, num_zones, survey_id)
+                   select bodies.ROWID, bodies.name, body_kinds.id, star_type, spectral_class, star_size,
+                          diameter, orbits, orbit_zones.id, num_zones, survey_id
+                   from bodies
+                   left join body_kinds on body_kinds.name = bodies.body_kind
+                   left join orbit_zones on orbit_zones.name = bodies.orbit_zone""")
+    con.execute("drop table bodies")
+    con.execute("alter table bodies_encoded rename to bodies")
+    con.execute("create index if not exists bodies_survey_id on bodies (survey_id)")
+    #dropping bodies took the body_names triggers with it
+    add_name_indexes(con)
+
+    create_search_table(con)
+
+
+def store_body_wide_once(con):
+    """
+    Schema version 11:  resources found in every zone of a body are stored once, with a NULL zone.
+
+    Any resource with the same quality and prevalence in each zone of its
+    body counts, since it looks the same to find_resources either way.
+    resources and resource_search are rebuilt, keeping the ROWIDs.
+    """
+
+    if has_table(con, 'zone_numbers'):
+        return
+
+    con.execute("drop trigger if exists resource_search_insert")
+    con.execute("drop trigger if exists resource_search_delete")
+    con.execute("drop table if exists resource_search")
+
+    con.execute("""create temp table body_wide (
+                    body_id     integer,
+                    name_id     integer,
+                    quality     integer,
+                    prevalence  integer,
+                    resource_id integer,
+                    primary key (body_id, name_id, quality, prevalence)
+                    )""")
+    con.execute("""insert into body_wide
+                   select resources.body_id, resources.name_id, resources.quality, resources.prevalence, min(resources.ROWID)
+                   from resources, bodies
+                   where bodies.ROWID = resources.body_id
+                   group by resources.body_id, resources.name_id, resources.quality, resources.prevalence
+                   having count(*) = bodies.num_zones and count(distinct resources.zone) = bodies.num_zones
+                      and min(resources.zone) = 0 and max(resources.zone) = bodies.num_zones - 1""")
+
+    con.execute("""create table resources_compact (
+                    name_id     integer,
+                    quality     integer,
+                    prevalence  integer,
+                    tl          integer,
+                    zone        integer,
+                    body_id     integer,
+                    survey_id   integer
+                    )""")
+    #keep one row of each body-wide resource, with the zone cleared, and everything else as it was
+    con.execute("""insert into resources_compact (ROWID, name_id, quality, prevalence, tl, zone, body_id, survey_id)
+                   select resources.ROWID, resources.name_id, resources.quality, resources.prevalence, resources.tl,
+                          case when body_wide.resource_id is null then resources.zone end,
+                          resources.body_id, resources.survey_id
+                   from resources
+                   left join body_wide on body_wide.body_id = resources.body_id
+                                      and body_wide.name_id = resources.name_id
+                                      and body_wide.quality = resources.quality
+                                      and body_wide.prevalence = resources.prevalence
+                   where body_wide.resource_id is null or body_wide.resource_id = resources.ROWID""")
+    con.execute("drop table body_wide")
+    con.execute("drop table resources")
+    con.execute("alter table resources_compact rename to resources")
+    con.execute("create index if not exists resources_survey_id on resources (survey_id)")
+    con.execute("create index if not exists resources_body_id on resources (body_id)")
+    con.execute("create index if not exists resources_name_tl_quality on resources (name_id, tl, quality)")
+
+    create_zone_numbers_table(con)
+    cur = con.cursor()
+    cur.execute("SELECT max(num_zones) FROM bodies")
+    add_zone_numbers(cur, cur.fetchone()[0] or 0)
+
+    create_search_table(con)
+
+
+def create_zone_numbers_table(con):
+    """Create zone_numbers, which search_resources joins against to expand body-wide resources into zones."""
+
+    con.execute("""create table if not exists zone_numbers (
+                    zone        integer primary key
+                    )""")
+
+
+def add_zone_numbers(cur, num_zones):
+    """Make sure zone_numbers goes up to the last zone of a body with num_zones zones, using cursor cur."""
+    cur.executemany("INSERT OR IGNORE INTO zone_numbers VALUES (?)", [(z,) for z in range(num_zones)])
+
+
+def store_diameter_metres(con):
+    """
+    Schema version 12:  diameters are numbers, in metres.
+
+    They used to be the text from the starmap, without its unit for stars
+    and planets, and in metres with an 'm' for ringworlds.  Stars are
+    converted as kilometres and everything else as metres, which is what
+    the starmaps use; "Reprocess DB" recomputes them from the starmaps
+    themselves.  bodies and resource_search are rebuilt, keeping the ROWIDs.
+    """
+
+    columns = dict([(row['name'], row['type']) for row in con.execute("PRAGMA table_info(bodies)")])
+    if columns.get('diameter') == 'real':
+        return
+
+    con.execute("drop trigger if exists resource_search_insert")
+    con.execute("drop trigger if exists resource_search_delete")
+    con.execute("drop table if exists resource_search")
+
+    def diameter_metres(text, body_kind):
+        if text is None:
+            return None
+        if body_kind == 'Star':
+            return survey.parse_diameter(text, 'km')
+        return survey.parse_diameter(text)
+    con.create_function('diameter_metres', 2, diameter_metres)
+
+    con.execute("""create table bodies_metric (
+                    name        text,
+                    body_kind_id    integer,
+                    star_type   text,
+                    spectral_class  text,
+                    star_size   text,
+                    diameter    real,
+                    orbits      text,
+                    orbit_zone_id   integer,
+                    num_zones   integer,
+                    survey_id   integer
+                    )""")
+    con.execute("""insert into bodies_metric (ROWID, name, body_kind_id, star_type, spectral_class, star_size,
+                                              diameter, orbits, orbit_zone_id, num_zones, survey_id)
+                   select bodies.ROWID, bodies.name, body_kind_id, star_type, spectral_class, star_size,
+                          diameter_metres(diameter, body_kinds.name), orbits, orbit_zone_id, num_zones, survey_id
+                   from bodies
+                   left join body_kinds on body_kinds.id = bodies.body_kind_id""")
+    con.execute("drop table bodies")
+    con.execute("alter table bodies_metric rename to bodies")
+    con.execute("create index if not exists bodies_survey_id on bodies (survey_id)")
+    con.execute("create index if not exists bodies_diameter on bodies (diameter)")
+    #dropping bodies took the body_names triggers with it
+    add_name_indexes(con)
+
+    create_search_table(con)
+
+
+def add_foreign_keys(con):
+    """
+    Schema version 13:  surveys are keyed by their universal coordinates, and own their rows.
+
+    surveys gets an integer primary key and a unique key on the universal
+    coordinates (x, y, z) of the system, so that saving a survey replaces
+    the old one in a single insert.  bodies, resources and wormholes
+    reference their survey with ON DELETE CASCADE.  All four tables are
+    rebuilt, keeping their ROWIDs, and rows left behind by old bugs are
+    dropped first.
+    """
+
+    columns = [row['name'] for row in con.execute("PRAGMA table_info(surveys)")]
+    if 'x' in columns:
+        return
+
+    #while the old triggers are still there to clean up after them
+    con.execute("DELETE FROM surveys WHERE ROWID NOT IN (SELECT max(ROWID) FROM surveys GROUP BY system_id)")
+    con.execute("DELETE FROM bodies WHERE survey_id NOT IN (SELECT ROWID FROM surveys)")
+    con.execute("DELETE FROM wormholes WHERE survey_id NOT IN (SELECT ROWID FROM surveys)")
+    con.execute("DELETE FROM resources WHERE body_id NOT IN (SELECT ROWID FROM bodies)")
+
+    con.execute("drop trigger if exists resource_search_insert")
+    con.execute("drop trigger if exists resource_search_delete")
+    con.execute("drop table if exists resource_search")
+
+    def system_coordinate(system_id, axis):
+        return float(system_id.split()[axis])
+    con.create_function('system_coordinate', 2, system_coordinate)
+
+    con.execute("""create table surveys_keyed (
+                    id          integer primary key,
+                    stored_date date,
+                    system_x    real,
+                    system_y    real,
+                    system_z    real,
+                    system_name text,
+                    system_id   text,
+                    sector_x    integer,
+                    sector_y    integer,
+                    sector_z    integer,
+                    sector_name text,
+                    sector_id   text,
+                    galaxy_name text,
+                    fingerprint text,
+                    x           real,
+                    y           real,
+                    z           real,
+                    unique (x, y, z)
+                    )""")
+    con.execute("""insert into surveys_keyed
+                   select ROWID, stored_date, system_x, system_y, system_z, system_name, system_id,
+                          sector_x, sector_y, sector_z, sector_name, sector_id, galaxy_name, fingerprint,
+                          system_coordinate(system_id, 0), system_coordinate(system_id, 1), system_coordinate(system_id, 2)
+                   from surveys""")
+
+    con.execute("""create table wormholes_keyed (
+                    polarity    text,
+                    source_id   text,
+                    dest_id     text,
+                    survey_id   integer references surveys (id) on delete cascade
+                    )""")
+    con.execute("""insert into wormholes_keyed (ROWID, polarity, source_id, dest_id, survey_id)
+                   select ROWID, polarity, source_id, dest_id, survey_id from wormholes""")
+
+    con.execute("""create table bodies_keyed (
+                    id          integer primary key,
+                    name        text,
+                    body_kind_id    integer,
+                    star_type   text,
+                    spectral_class  text,
+                    star_size   text,
+                    diameter    real,
+                    orbits      text,
+                    orbit_zone_id   integer,
+                    num_zones   integer,
+                    survey_id   integer references surveys (id) on delete cascade
+                    )""")
+    con.execute("""insert into bodies_keyed
+                   select ROWID, name, body_kind_id, star_type, spectral_class, star_size,
+                          diameter, orbits, orbit_zone_id, num_zones, survey_id
+                   from bodies""")
+
+    con.execute("""create table resources_keyed (
+                    name_id     integer,
+                    quality     integer,
+                    prevalence  integer,
+                    tl          integer,
+                    zone        integer,
+                    body_id     integer,
+                    survey_id   integer references surveys (id) on delete cascade
+                    )""")
+    con.execute("""insert into resources_keyed (ROWID, name_id, quality, prevalence, tl, zone, body_id, survey_id)
+                   select ROWID, name_id, quality, prevalence, tl, zone, body_id, survey_id from resources""")
+
+    for table in ('resources', 'bodies', 'wormholes', 'surveys'):
+        con.execute("drop table %s" % table)
+        con.execute("alter table %s_keyed rename to %s" % (table, table))
+
+    con.execute("create index if not exists resources_survey_id on resources (survey_id)")
+    con.execute("create index if not exists resources_body_id on resources (body_id)")
+    con.execute("create index if not exists resources_name_tl_quality on resources (name_id, tl, quality)")
+    con.execute("create index if not exists bodies_survey_id on bodies (survey_id)")
+    con.execute("create index if not exists bodies_diameter on bodies (diameter)")
+    con.execute("create index if not exists wormholes_survey_id on wormholes (survey_id)")
+    #dropping surveys and bodies took their triggers with them
+    add_location_index(con)
+    add_name_indexes(con)
+
+    create_search_table(con)
+
+
+def sort_resource_names(cur, tables=('resources', 'resource_search')):
+    """
+    Renumber resource_names so the ids are in alphabetical order, using cursor cur.
+
+    The name_id column of each of tables is updated to match.
+
+    resource_search is clustered by name_id, so this is what lets searches
+    come back sorted by name without a sort step.  Nearly every name is in
+    the seed list, so this only has work to do when the game adds one.
+    """
+    cur.execute("SELECT id FROM resource_names ORDER BY name COLLATE NOCASE, name")
+    mapping = [(new_id, row[0]) for new_id, row in enumerate(cur.fetchall(), 1) if new_id != row[0]]
+    if len(mapping) == 0:
+        return
+
+    cur.execute("create temp table if not exists name_map (old_id integer primary key, new_id integer)")
+    cur.execute("DELETE FROM name_map")
+    cur.executemany("INSERT INTO name_map (new_id, old_id) VALUES (?,?)", mapping)
+    #go through negative ids so they never collide on the way
+    cur.execute("UPDATE resource_names SET id = -(SELECT new_id FROM name_map WHERE old_id = id) WHERE id IN (SELECT old_id FROM name_map)")
+    cur.execute("UPDATE resource_names SET id = -id WHERE id < 0")
+    for table in tables:
+        cur.execute("UPDATE %s SET name_id = (SELECT new_id FROM name_map WHERE old_id = name_id) WHERE name_id IN (SELECT old_id FROM name_map)" % table)
+    cur.execute("DELETE FROM name_map")
+
+
+def fill_missing_search_names(con):
+    """
+    Schema version 14:  resource_search's trigger stores missing sector, system and body names as ''.
+
+    Its primary key can't hold NULLs, so a starmap with a nameless sector,
+    system or body failed to save.
+    """
+
+    con.execute("drop trigger if exists resource_search_insert")
+    con.execute("""create trigger resource_search_insert after insert on resources
+                   begin
+                       insert into resource_search %s;
+                   end""" % search_select('new'))
+
+
+#the schema migrations, in order; a database's user_version is how many have been applied
+MIGRATIONS = [
+    create_base_tables,
+    add_fingerprint_column,
+    add_indexes,
+    add_location_index,
+    add_name_indexes,
+    add_search_table,
+    add_raw_codec_column,
+    add_raw_hash_column,
+    add_checkpoints_table,
+    encode_names,
+    store_body_wide_once,
+    store_diameter_metres,
+    add_foreign_keys,
+    fill_missing_search_names,
+    ]
+
+def migrate(con):
+    """
+    Bring the schema of the database behind con up to date.
+
+    Each migration runs in its own transaction along with the bump of
+    user_version, so one that fails partway leaves the database as it was
+    before it, rather than half rebuilt.  sqlite3 would otherwise commit
+    implicitly before each schema statement, so the connection is switched
+    to autocommit mode meanwhile and the transactions are explicit.
+    Foreign keys are off while they run, since dropping a table that others
+    refer to would otherwise delete their rows.
+    """
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
     con.commit()
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    con.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for number in range(version, len(MIGRATIONS)):
+            con.execute("BEGIN")
+            try:
+                MIGRATIONS[number](con)
+                con.execute("PRAGMA user_version = %d" % (number+1))
+                con.execute("COMMIT")
+            except:
+                con.execute("ROLLBACK")
+                raise
+        con.execute("ANALYZE")
+    finally:
+        con.execute("PRAGMA foreign_keys = ON")
+        con.isolation_level = isolation_level
+
+
+#number of systems written per executemany batch during ingest
+BATCH_SIZE = 500
+
+
+class Cancelled(Exception):
+    """Raised when an ingest is stopped through its progress callback."""
+
+
+class IngestProgress:
+    """
+    Counts the work done so far by add_files or add_files_from_internal_raws.
+
+    After each batch of surveys is written, the object is passed to the
+    callback given to those functions.  If the callback returns False, the
+    ingest raises Cancelled and nothing it wrote is kept.
+    """
+    def __init__(self, callback, total_files, total_bytes):
+        self.callback = callback
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.systems = 0
+        self.rows = 0
+        self.bytes = 0
+        self.start = time.time()
+        #the file handler being parsed, and the bytes of the files before it
+        self.fh = None
+        self.done_bytes = 0
+
+    def watch(self, fh):
+        """Count the bytes read from file handler fh as progress through the current file."""
+        self.fh = fh
+
+    def add(self, systems, rows):
+        """Record that a batch was written, and report."""
+        self.systems += systems
+        self.rows += rows
+        self.report()
+
+    def finish_file(self, size):
+        """Record that a file of size bytes is done, and report."""
+        self.files += 1
+        self.fh = None
+        self.done_bytes += size
+        self.bytes = self.done_bytes
+        self.report()
+
+    def report(self):
+        if self.fh is not None and not self.fh.closed:
+            self.bytes = self.done_bytes + self.fh.tell()
+        if self.callback is not None and self.callback(self) is False:
+            raise Cancelled()
+
+    def elapsed(self):
+        return max(time.time() - self.start, 0.001)
+
+    def fraction(self):
+        """Return how much of the work is done, between 0 and 1."""
+        if self.total_bytes > 0:
+            return min(float(self.bytes) / self.total_bytes, 1.0)
+        if self.total_files > 0:
+            return float(self.files) / self.total_files
+        return 0.0
+
+    def eta(self):
+        """Return the estimated seconds remaining, or None if it's too early to tell."""
+        fraction = self.fraction()
+        if fraction <= 0:
+            return None
+        return self.elapsed() * (1 - fraction) / fraction
+
+
+#how new raw files are compressed; see survey.open_starmap_buffer
+RAW_CODEC = 'zlib'
+
+def add_raw_file(filename, cur):
+    """Add the raw file itself to the DB, compressed, unless an identical one is already there."""
+    if filename is not None:
+        #read it a piece at a time, so only the compressed copy is held whole
+        digest = hashlib.sha1()
+        compressor = zlib.compressobj(9)
+        compressed = []
+        f = open(filename, 'rb')
+        try:
+            while True:
+                data = f.read(1024*1024)
+                if not data:
+                    break
+                digest.update(data)
+                compressed.append(compressor.compress(data))
+        finally:
+            f.close()
+        compressed.append(compressor.flush())
+        cur.execute("""insert or ignore into raws (hash, filename, added_date, data, codec)
+                       values (?,?,?,?,?)""",
+                    (digest.hexdigest(), os.path.basename(filename), datetime.datetime.now(),
+                     buffer(''.join(compressed)), RAW_CODEC))
+
+
+def raw_digest(f):
+    """Return the SHA-1 of everything read from file handler f, which is then closed."""
+    digest = hashlib.sha1()
+    try:
+        while True:
+            data = f.read(1024*1024)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def compress_raws():
+    """
+    Compress any raw files still stored as plain XML, then VACUUM the database.
+
+    Only one file is held in memory at a time.  Returns the number of raw
+    files compressed.
+    """
+    con = get_writer()
+    cur = con.cursor()
+    cur.execute("SELECT ROWID FROM raws WHERE codec IS NULL")
+    raw_ids = [row[0] for row in cur.fetchall()]
+    for raw_id in raw_ids:
+        cur.execute("SELECT data FROM raws WHERE ROWID = ?", (raw_id,))
+        data = cur.fetchone()[0]
+        cur.execute("UPDATE raws SET data = ?, codec = ? WHERE ROWID = ?",
+                    (buffer(zlib.compress(data, 9)), RAW_CODEC, raw_id))
+        con.commit()
+    #give the freed pages back to the filesystem
+    con.execute("VACUUM")
+    #VACUUM writes the whole database through the WAL
+    checkpoint(con)
     con.close()
+    return len(raw_ids)
+
+
+def next_rowid(cur, table):
+    """Return the ROWID that the next row inserted into table would get."""
+    cur.execute("SELECT max(ROWID) FROM %s" % table)
+    return (cur.fetchone()[0] or 0) + 1
+
+
+def insert_surveys(cur, systems):
+    """
+    Insert a batch of survey.SystemRows using cursor cur, without committing.
+
+    Returns the number of rows inserted.
+
+    Any surveys already stored for the same systems are replaced, and if
+    the batch holds several surveys of one system only the last is kept.
+    ROWIDs are assigned here rather than by sqlite, so that each table can
+    be written with a single executemany while the bodies still know which
+    ROWID the resources should point at.
+    """
+    #only the last survey of each system in the batch matters
+    latest = {}
+    for s in systems:
+        latest[s.system_id] = s
+    systems = [s for s in systems if latest[s.system_id] is s]
+
+    names = lookup_ids(cur, 'resource_names', set([r[0] for s in systems for r in s.resources]), missing='')
+    kinds = lookup_ids(cur, 'body_kinds', set([b[1] for s in systems for b in s.bodies]))
+    zones = lookup_ids(cur, 'orbit_zones', set([b[7] for s in systems for b in s.bodies]))
+    add_zone_numbers(cur, max([b[8] for s in systems for b in s.bodies] + [0]))
+
+    now = datetime.datetime.now()
+    survey_id = next_rowid(cur, 'surveys')
+    body_id = next_rowid(cur, 'bodies')
+    surveys = []
+    wormholes = []
+    bodies = []
+    resources = []
+    for s in systems:
+        surveys.append((survey_id, now) + s.survey)
+        wormholes.extend([w + (survey_id,) for w in s.wormholes])
+        bodies.extend([(body_id + i, b[0], kinds[b[1]]) + b[2:7] + (zones[b[7]], b[8], survey_id) for i, b in enumerate(s.bodies)])
+        resources.extend([(names[r[0]],) + r[1:5] + (body_id + r[5], survey_id) for r in s.resources])
+        body_id += len(s.bodies)
+        survey_id += 1
+
+    #the unique key on (x, y, z) makes each of these replace the system's old
+    #survey, and the foreign keys take the old bodies, resources and wormholes
+    cur.executemany("""insert or replace into surveys (ROWID, stored_date,
+                           system_x, system_y, system_z, system_name, system_id,
+                           sector_x, sector_y, sector_z, sector_name, sector_id,
+                           galaxy_name, fingerprint, x, y, z)
+                       values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", surveys)
+    cur.executemany("insert into wormholes (polarity, source_id, dest_id, survey_id) values (?,?,?,?)", wormholes)
+    cur.executemany("""insert into bodies (ROWID, name, body_kind_id, star_type,
+                           spectral_class, star_size, diameter, orbits,
+                           orbit_zone_id, num_zones, survey_id)
+                       values (?,?,?,?,?,?,?,?,?,?,?)""", bodies)
+    cur.executemany("""insert into resources (name_id, quality, prevalence, tl, zone, body_id, survey_id)
+                       values (?,?,?,?,?,?,?)""", resources)
+    return len(surveys) + len(wormholes) + len(bodies) + len(resources)
+
+
+def lookup_ids(cur, table, names, missing=None):
+    """
+    Return a dictionary of the ids of names in lookup table, using cursor cur.
+
+    Names that aren't in the table yet are added first.  None maps to the id
+    of missing, or to None if missing is None.
+    """
+    names = [missing if name is None else name for name in names]
+    cur.execute("SELECT name, id FROM %s" % table)
+    ids = dict([(row[0], row[1]) for row in cur.fetchall()])
+    added = [(name,) for name in names if name is not None and name not in ids]
+    if len(added) > 0:
+        cur.executemany("INSERT OR IGNORE INTO %s (name) VALUES (?)" % table, added)
+        if table == 'resource_names':
+            sort_resource_names(cur)
+        cur.execute("SELECT name, id FROM %s" % table)
+        ids = dict([(row[0], row[1]) for row in cur.fetchall()])
+    ids[None] = ids.get(missing)
+    return ids
+
+
+def get_lookup_names(table):
+    """Return the names in lookup table, in id order."""
+    con = get_con()
+    names = [row[0] for row in con.execute("SELECT name FROM %s ORDER BY id" % table)]
+    con.close()
+    return names
+
+def get_resource_names():
+    """Return every resource name, alphabetically."""
+    #'' stands for a missing name
+    return [name for name in get_lookup_names('resource_names') if name != '']
+
+def get_body_kinds():
+    """Return every body kind, with the numbered Ringworld arcs folded into 'Ringworld'."""
+    kinds = []
+    for kind in get_lookup_names('body_kinds'):
+        if kind.startswith('Ringworld'):
+            kind = 'Ringworld'
+        if kind not in kinds:
+            kinds.append(kind)
+    return kinds
+
+def get_orbit_zones():
+    """Return every orbit zone, from the innermost out."""
+    return get_lookup_names('orbit_zones')
+
+
+def remove_surveys(cur, survey_ids):
+    """
+    Delete surveys and all information associated with them using cursor cur, without committing.
+
+    The foreign keys take the bodies, resources and wormholes along.
+    """
+    cur.executemany("DELETE FROM surveys WHERE ROWID = ?", [(survey_id,) for survey_id in survey_ids])
 
 
 def save_survey(system, filename=None):
     """Save a survey.system to the database."""
 
-    def add_raw_file(filename, con, cur):
-        """Add the raw file itself to the DB."""
-        if filename is not None:
-            f = open(filename, 'rb')
-            data = f.read()
-            f.close()
-            cur.execute("insert into raws values (?,?)", (os.path.basename(filename), buffer(data)))
+    con = get_writer()
+    cur = con.cursor()
+    add_raw_file(filename, cur)
+    insert_surveys(cur, [survey.system_rows(system)])
+    con.commit()
+    con.close()
 
 
-    con = get_con()
+def save_surveys(systems, filename=None, known=None):
+    """
+    Save an iterable of survey.systems to the database in one transaction.
+
+    The systems are written in batches of BATCH_SIZE.  If filename is given,
+    the raw file is stored once alongside them.  If known is a KnownSurveys,
+    systems it already has are skipped and the saved ones are added to it.
+
+    Returns the number of surveys saved.
+    """
+    con = get_writer()
     cur = con.cursor()
+    try:
+        add_raw_file(filename, cur)
+        count = write_surveys(cur, itertools.imap(survey.system_rows, systems), known)
+        con.commit()
+    finally:
+        con.close()
+    return count
 
-    #find out if there is already an entry for this system
-    #TODO: do this while initially processing the file, to skip processing old ones
-    cur.execute("""SELECT ROWID
-                   FROM surveys
-                   WHERE system_id = ?
-                   """, (str(system.location.universal_coords),))
-    rows = cur.fetchall()
-    for row in rows:
-        #delete the old survey before we add the new one
-        delete_survey(row[0])
-
-    add_raw_file(filename, con, cur)
-
-    #add the survey
-    cur.execute("insert into surveys values (?,?,?,?,?,?,?,?,?,?,?,?)", (
-            datetime.datetime.now(),
-            system.location.system_coords.x, system.location.system_coords.y, system.location.system_coords.z,
-            system.location.system_name, str(system.location.universal_coords),
-            system.location.sector_coords.x, system.location.sector_coords.y, system.location.sector_coords.z,
-            system.location.sector_name, str(system.location.sector_coords),
-            system.galaxy,
-            ))
-    survey_id = cur.lastrowid
-
-    #add the wormholes
-    for w in system.wormholes:
-        cur.execute("insert into wormholes values (?,?,?,?)", (
-                w.polarity,
-                str(w.source.universal_coords),
-                str(w.dest.universal_coords),
-                survey_id
-                ))
 
-    #add the bodies
-    for b in system.bodies:
-        cur.execute("insert into bodies values (?,?,?,?,?,?,?,?,?,?)", (
-                b.name,
-                b.body_kind,
-                b.star_type,
-                b.spectral_class,
-                b.star_size,
-                b.diameter,
-                b.orbits,
-                b.orbit_zone,
-                len(b.zones),
-                survey_id
-                ))
-        body_id = cur.lastrowid
-
-        #add the resources
-        for z in range(len(b.zones)):
-            for r in b.zones[z].resources:
-                cur.execute("insert into resources values (?,?,?,?,?,?,?)", (
-                        r.name,
-                        r.quality,
-                        r.prevalence,
-                        r.tl,
-                        z,
-                        body_id,
-                        survey_id
-                        ))
+def write_surveys(cur, systems, known=None, progress=None):
+    """
+    Write an iterable of survey.SystemRows in batches using cursor cur, without committing.
+
+    known is as for save_surveys.  If progress is an IngestProgress, it is
+    updated after each batch.
+
+    Returns the number of surveys written.
+    """
+    count = 0
+    batch = []
+    for s in systems:
+        if known is not None:
+            if s.fingerprint in known:
+                continue
+            known.add(s)
+        batch.append(s)
+        if len(batch) >= BATCH_SIZE:
+            rows = insert_surveys(cur, batch)
+            count += len(batch)
+            if progress is not None:
+                progress.add(len(batch), rows)
+            batch = []
+    rows = insert_surveys(cur, batch)
+    count += len(batch)
+    if progress is not None:
+        progress.add(len(batch), rows)
+    return count
 
 
+def gather_statistics(con):
+    """
+    Run ANALYZE on the database behind con if resource_search has no statistics yet, and commit.
+
+    migrate runs ANALYZE while a new database is still empty, which leaves
+    the query planner guessing until something like this runs after the
+    first ingest.
+    """
+    if has_table(con, 'sqlite_stat1'):
+        if con.execute("SELECT 1 FROM sqlite_stat1 WHERE tbl = 'resource_search'").fetchone() is not None:
+            return
+    con.execute("ANALYZE")
     con.commit()
-    con.close()
 
 
 def delete_survey(survey_id):
     """Delete from the database a survey and all information associated with it."""
 
-    con = get_con()
+    con = get_writer()
     cur = con.cursor()
-
-    cur.execute("DELETE FROM surveys WHERE ROWID = ?", (
-            survey_id,
-            ))
-    cur.execute("DELETE FROM wormholes WHERE survey_id = ?", (
-            survey_id,
-            ))
-    cur.execute("DELETE FROM bodies WHERE survey_id = ?", (
-            survey_id,
-            ))
-    cur.execute("DELETE FROM resources WHERE survey_id = ?", (
-            survey_id,
-            ))
-
+    remove_surveys(cur, [survey_id])
     con.commit()
     con.close()
 
@@ -229,12 +1556,22 @@ def add_text(text):
     return 0
 
 
+def report_throughput(count, start):
+    """Print how many surveys were added since time start, and how quickly."""
+    elapsed = max(time.time() - start, 0.001)
+    print("%d surveys added in %.2f seconds (%.0f systems/sec)" % (count, elapsed, count/elapsed))
+
+
 def is_new_file(path):
-    """Returns True if filename pointed to by path is not already in the database."""
-    query = "SELECT filename FROM raws WHERE filename = ?"
+    """
+    Returns True if the file pointed to by path is not already in the database.
+
+    Files are matched by the SHA-1 of their contents, not by name.
+    """
+    query = "SELECT hash FROM raws WHERE hash = ?"
     con = get_con()
     cur = con.cursor()
-    cur.execute(query, (os.path.basename(path),))
+    cur.execute(query, (raw_digest(open(path, 'rb')),))
     rows = cur.fetchall()
     con.close()
 
@@ -242,49 +1579,199 @@ def is_new_file(path):
 
 
 
-def add_files_from_internal_raws():
+def add_files_from_internal_raws(progress=None):
     """
     Add any surveys found in the internal raws to the database.
 
+    The raws are read one at a time, so only one is ever held in memory.
+    Each is committed together with a checkpoint, and if a reprocess is
+    interrupted the next one resumes after the last raw it finished.
+
+    If progress is given, it is called with an IngestProgress after each
+    batch; if it returns False the raw being processed is rolled back and
+    Cancelled is raised, leaving the checkpoint for the next call.
+
     Returns total number of surveys added.
     """
-    query = "SELECT filename, data FROM raws"
-    con = get_con()
-    cur = con.cursor()
-    cur.execute(query)
-    rows = cur.fetchall()
-    con.close()
-
-    if len(rows) == 0:
-        print("Error, stored surveys.")
-        return 0
-    count = 0
     create_tables()
-    for row in rows:
-        f = row[0]
-        print("Processing file: " + f)
-        surveys = survey.process_starmap_buffer(row[1])
-        for s in surveys:
-            save_survey(s)
-        count += len(surveys)
+    con = get_writer()
+    cur = con.cursor()
+    try:
+        cur.execute("SELECT raw_id FROM checkpoints WHERE task = 'reprocess'")
+        row = cur.fetchone()
+        after = 0
+        if row is not None:
+            after = row[0]
+            print("Resuming reprocess after stored file %d" % after)
+
+        #just the sizes for now; each blob is read when its turn comes
+        cur.execute("SELECT ROWID, filename, length(data) FROM raws WHERE ROWID > ? ORDER BY ROWID", (after,))
+        raws = cur.fetchall()
+        if len(raws) == 0:
+            if after == 0:
+                print("Error, stored surveys.")
+            cur.execute("DELETE FROM checkpoints WHERE task = 'reprocess'")
+            con.commit()
+            return 0
+
+        count = 0
+        start = time.time()
+        tracker = IngestProgress(progress, len(raws), sum([raw[2] for raw in raws]))
+        for raw_id, f, size in raws:
+            print("Processing file: " + f)
+            cur.execute("SELECT data, codec FROM raws WHERE ROWID = ?", (raw_id,))
+            row = cur.fetchone()
+            fh = survey.open_starmap_buffer(row[0], row[1])
+            tracker.watch(fh)
+            count += write_surveys(cur, survey.iter_starmap_rows(fh), progress=tracker)
+            #let go of this blob before the next one is read
+            row = fh = None
+            cur.execute("INSERT OR REPLACE INTO checkpoints VALUES ('reprocess', ?)", (raw_id,))
+            con.commit()
+            checkpoint(con)
+            tracker.finish_file(size)
+        cur.execute("DELETE FROM checkpoints WHERE task = 'reprocess'")
+        con.commit()
+        gather_statistics(con)
+    finally:
+        #closing without a commit rolls back the raw that was in progress
+        con.close()
+    report_throughput(count, start)
     return count
 
 
 
-def add_files(files):
+class KnownSurveys:
+    """
+    Tracks the fingerprint of the stored survey of each system.
+
+    This is used as the 'skip' test for the survey.iter_starmap_* functions,
+    so that systems which have not changed since they were last added are
+    neither built nor written again.
+    """
+    def __init__(self):
+        self.by_system = {}
+        self.fingerprints = set()
+        con = get_con()
+        for row in con.execute("SELECT system_id, fingerprint FROM surveys"):
+            self.by_system[row[0]] = row[1]
+        con.close()
+        self.fingerprints.update(self.by_system.values())
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.fingerprints
+
+    def add(self, rows):
+        """Record that the survey.SystemRows rows has been saved, replacing any older survey."""
+        self.fingerprints.discard(self.by_system.get(rows.system_id))
+        self.by_system[rows.system_id] = rows.fingerprint
+        self.fingerprints.add(rows.fingerprint)
+
+
+#the fingerprints known when the parse_starmap_file worker pool was started
+worker_fingerprints = set()
+
+def init_parse_worker(fingerprints):
+    """Initializer for the parse_starmap_file worker processes."""
+    global worker_fingerprints
+    worker_fingerprints = fingerprints
+
+
+def parse_starmap_file(path):
+    """
+    Parse starmap file 'path' in a worker process.
+
+    Systems that match the fingerprints given to init_parse_worker are
+    skipped.  Returns a tuple of the list of survey.SystemRows and the list of the
+    fingerprints that were skipped.
+    """
+    skipped = []
+    def skip(fingerprint):
+        if fingerprint in worker_fingerprints:
+            skipped.append(fingerprint)
+            return True
+        return False
+    return (list(survey.iter_starmap_file_rows(path, skip)), skipped)
+
+
+def add_files(files, jobs=1, progress=None):
     """
     Add the surveys in the array of files to the database.
 
+    Files whose contents are already stored in the raws table are skipped
+    without being parsed.  Of the rest, systems whose fingerprint matches
+    the survey already stored for them are skipped, so only new or changed
+    systems are written.
+
+    Each file is committed along with its raw copy as soon as it is done.
+    If progress is given, it is called with an IngestProgress after each
+    batch; if it returns False the file in progress is rolled back and
+    Cancelled is raised.  The files finished before it are kept, and are
+    skipped if they are added again.
+
+    If jobs is more than 1, the files are parsed by a pool of that many
+    worker processes while this process does all the database writing.
+    Results are still saved in the order the files were given, so the
+    newest survey of each system wins exactly as it does in a serial run.
+
     Returns total number of surveys added.
     """
     count = 0
     create_tables()
+    start = time.time()
+
+    con = get_con()
+    stored = set([row[0] for row in con.execute("SELECT hash FROM raws")])
+    con.close()
+    new_files = []
     for f in files:
-        print("Processing file: " + f)
-        surveys = survey.process_starmap_file(f)
-        for s in surveys:
-            save_survey(s, f)
-        count += len(surveys)
+        digest = raw_digest(open(f, 'rb'))
+        if digest in stored:
+            print("Skipping file, already in the database: " + f)
+            continue
+        stored.add(digest)
+        new_files.append(f)
+    files = new_files
+
+    known = KnownSurveys()
+    tracker = IngestProgress(progress, len(files), sum([os.path.getsize(f) for f in files]))
+
+    def parse_here(path):
+        fh = open(path, 'rb')
+        tracker.watch(fh)
+        return survey.iter_starmap_rows(fh, known.__contains__)
+
+    pool = None
+    if jobs > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(files)), init_parse_worker, (known.fingerprints,))
+        results = pool.imap(parse_starmap_file, files)
+    else:
+        results = ((parse_here(f), []) for f in files)
+    con = get_writer()
+    cur = con.cursor()
+    try:
+        for f, (surveys, skipped) in itertools.izip(files, results):
+            print("Processing file: " + f)
+            for fingerprint in skipped:
+                if fingerprint not in known:
+                    #an earlier file replaced a survey the worker skipped, so
+                    #the worker's view is stale; parse this one again here
+                    surveys = parse_here(f)
+                    break
+            add_raw_file(f, cur)
+            count += write_surveys(cur, surveys, known, tracker)
+            #a file at a time, so searches see it and the WAL can be emptied
+            con.commit()
+            checkpoint(con)
+            tracker.finish_file(os.path.getsize(f))
+        gather_statistics(con)
+    finally:
+        #closing without a commit rolls back the file that was in progress
+        con.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    report_throughput(count, start)
     return count
 
 
@@ -311,138 +1798,604 @@ def is_number(x):
     return True
 
 
-def find_resources(name=None,exactname=None,mintl=None,orbit_zones=None,body_kinds=None,planet=None,system=None,sector=None,galaxy=None,minsecx=None,minsecy=None,minsecz=None,maxsecx=None,maxsecy=None,maxsecz=None,centerx=None,centery=None,centerz=None,radius=None):
-    """Find resources matching parameters and return as list of dictionaries."""
-    query = """SELECT resources.name,
-                      resources.tl,
-                      resources.quality,
-                      resources.prevalence,
-                      bodies.diameter,
-                      bodies.body_kind,
-                      bodies.orbit_zone,
-                      resources.zone,
-                      surveys.galaxy_name,
-                      surveys.sector_name,
-                      surveys.system_name,
-                      surveys.system_id,
-                      bodies.name
-               FROM resources LEFT JOIN bodies,surveys ON (resources.body_id = bodies.ROWID AND resources.survey_id = surveys.ROWID)
+def rebuild_search_table():
+    """Rebuild resource_search from scratch, from the resources, bodies and surveys tables."""
+
+    con = get_writer()
+    con.execute("DELETE FROM resource_search")
+    con.execute("INSERT INTO resource_search %s" % search_select())
+    con.commit()
+    con.execute("ANALYZE resource_search")
+    con.commit()
+    con.close()
+
+
+def has_table(con, name):
+    """Check whether the database behind con has a table (or virtual table) called name."""
+    cur = con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cur.fetchone() is not None
+
+
+#the keys of the values in each row returned by search_resources
+RESULT_KEYS = (
+    'Resource',
+    'TL',
+    'Qual',
+    'Freq',
+    'Diameter',
+    'Kind',
+    'Type',
+    'Zone',
+    'Galaxy',
+    'Sector',
+    'System',
+    'Coords',
+    'World',
+    'Distance',
+    )
+
+
+def find_resources(**kwargs):
+    """
+    Find resources matching parameters and return as list of dictionaries.
+
+    Takes the same parameters as search_resources.
+    """
+    return format_as_assoc(search_resources(**kwargs), RESULT_KEYS)
+
+
+#a search result with its values named after RESULT_KEYS, undecorated
+ResultRow = collections.namedtuple('ResultRow', RESULT_KEYS)
+
+def iter_resources(after=None, con=None, **kwargs):
+    """
+    Find resources matching parameters and yield them one at a time, as (ResultRow, key).
+
+    Takes the same parameters as search_resources, and yields the rows in
+    the same order, but fetches them from the database FETCH_SIZE at a
+    time as they are needed instead of all at once.  A row's key can be
+    passed as after to carry on with the rows after it.
+    """
+    close = con is None
+    if con is None:
+        con = get_con()
+    try:
+        query, parameters, columnar_search = search_query(con, after=after, keyed=True, **kwargs)
+        cur = con.cursor()
+        cur.row_factory = None
+        cur.execute(query, parameters)
+        width = len(RESULT_KEYS)
+        while True:
+            batch = cur.fetchmany(FETCH_SIZE)
+            if len(batch) == 0:
+                break
+            for row in batch:
+                yield ResultRow._make(row[:width]), row[width:]
+    finally:
+        if close:
+            con.close()
+
+def find_resources_page(page_size, after=None, count=False, con=None, **kwargs):
+    """
+    Find a page of the resources matching parameters, and return as (rows, next, total).
+
+    Takes the same parameters as search_resources.  rows is a list of up to
+    page_size ResultRows, starting after the key after, or at the start.
+    next is the key to pass as after for the next page, or None if this is
+    the last one.  total is the number of rows on all the pages if count
+    is True, which takes as long as a whole search, or else None.
+
+    Only the rows of the page are read, so the first one is quick to get
+    even when there are hundreds of thousands more.
+    """
+    close = con is None
+    if con is None:
+        con = get_con()
+    try:
+        #one extra, to see whether there is another page
+        query, parameters, columnar_search = search_query(con, after=after, limit=page_size+1, keyed=True, **kwargs)
+        cur = con.cursor()
+        cur.row_factory = None
+        fetched = cur.execute(query, parameters).fetchall()
+        width = len(RESULT_KEYS)
+        rows = [ResultRow._make(row[:width]) for row in fetched[:page_size]]
+        next = None
+        if len(fetched) > page_size:
+            next = fetched[page_size-1][width:]
+        total = None
+        if count:
+            total = count_resources(con=con, **kwargs)
+    finally:
+        if close:
+            con.close()
+    return rows, next, total
+
+def count_resources(con=None, **kwargs):
+    """
+    Return the number of resources matching parameters.  Takes the same parameters as search_resources.
+
+    With no parameters, every resource matches.
+
+    >>> con = connect(':memory:')
+    >>> migrate(con)
+    >>> count_resources(con=con)
+    0
+    >>> find_resources_page(10, con=con)
+    ([], None, None)
+    >>> list(iter_resources(con=con))
+    []
+    >>> query_resources(con=con)
+    []
+    """
+    close = con is None
+    if con is None:
+        con = get_con()
+    try:
+        query, parameters, columnar_search = search_query(con, count=True, **kwargs)
+        return con.execute(query, parameters).fetchone()[0]
+    finally:
+        if close:
+            con.close()
+
+
+#number of rows search_resources fetches at a time
+FETCH_SIZE = 1000
+
+
+#settings for search_cache, under /search/ in the config
+SEARCH_SETTINGS = {
+    #searches whose results are kept
+    'cache_entries': 16,
+    #rows kept in all, at roughly 1 KB each; bigger results aren't kept
+    'cache_rows': 500*1000,
+    }
+
+def get_search_setting(name):
+    """Return the search setting called name from the config, or its default."""
+    key = '/search/' + name
+    if not wx.Config.Get().HasEntry(key):
+        return SEARCH_SETTINGS[name]
+    return wx.Config.Get().ReadInt(key)
+
+
+class SearchCache:
+    """
+    The results of the most recently used searches, by their parameters.
+
+    Any change to the database bumps the generation and empties the cache.
+    Results are put under the generation that was current when their search
+    started, and dropped if it has changed since, so a search that overlaps
+    a write can't leave stale results behind.
+
+    At most entries searches are kept, and max_rows rows in all.  The
+    searches run in other threads, so the limits are handed in rather than
+    read from the config; see configure_search_cache.
+    """
+    def __init__(self, entries, max_rows):
+        self.lock = threading.Lock()
+        self.entries = entries
+        self.max_rows = max_rows
+        self.results = collections.OrderedDict()
+        self.rows = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the rows kept for key, or None, and the generation to put them under otherwise."""
+        with self.lock:
+            rows = self.results.pop(key, None)
+            if rows is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                #back to the most recently used end
+                self.results[key] = rows
+            return rows, self.generation
+
+    def put(self, key, generation, rows):
+        """Keep rows for key, if nothing has changed since generation, dropping the least recently used."""
+        with self.lock:
+            if generation != self.generation or key in self.results:
+                return
+            if self.entries <= 0 or len(rows) > self.max_rows:
+                return
+            self.results[key] = rows
+            self.rows += len(rows)
+            self.shrink()
+
+    def set_limits(self, entries, max_rows):
+        """Change how many searches and rows are kept, dropping the least recently used to fit."""
+        with self.lock:
+            self.entries = entries
+            self.max_rows = max_rows
+            self.shrink()
+
+    def shrink(self):
+        """Drop the least recently used results until the rest fit the limits; the lock must be held."""
+        while len(self.results) > 0 and (len(self.results) > self.entries or self.rows > self.max_rows):
+            old_key, old_rows = self.results.popitem(last=False)
+            self.rows -= len(old_rows)
+
+    def invalidate(self):
+        """Forget everything, because the database has changed."""
+        with self.lock:
+            self.generation += 1
+            self.results.clear()
+            self.rows = 0
+
+    def statistics(self):
+        """Return the number of hits and misses so far."""
+        with self.lock:
+            return (self.hits, self.misses)
+
+search_cache = SearchCache(SEARCH_SETTINGS['cache_entries'], SEARCH_SETTINGS['cache_rows'])
+
+def configure_search_cache():
+    """Set search_cache's limits from the config; wx.Config belongs to the main thread, so call it from there."""
+    search_cache.set_limits(get_search_setting('cache_entries'), get_search_setting('cache_rows'))
+
+
+def search_key(params):
+    """Return search_resources parameters as a key for search_cache, ignoring the ones that aren't set."""
+    key = []
+    for name in sorted(params):
+        value = params[name]
+        if value is None or value == '' or value == []:
+            continue
+        if isinstance(value, list):
+            #the order of orbit zones and body kinds doesn't change the results
+            value = tuple(sorted(value))
+        key.append((name, value))
+    return tuple(key)
+
+
+def search_resources(name=None,exactname=None,mintl=None,orbit_zones=None,body_kinds=None,planet=None,system=None,sector=None,galaxy=None,minsecx=None,minsecy=None,minsecz=None,maxsecx=None,maxsecy=None,maxsecz=None,centerx=None,centery=None,centerz=None,radius=None,mindiameter=None,maxdiameter=None,con=None,progress=None,first_page=None):
+    """
+    Find resources matching parameters and return as a list of tuples.
+
+    The values in each tuple are undecorated, in the order of RESULT_KEYS.
+    mindiameter and maxdiameter are in metres, or text with a unit like
+    '5 km'.
+
+    If con is given the query runs on that connection, which is left open;
+    this lets another thread stop it with con.interrupt().  If progress is
+    given, it is called with the number of rows fetched so far after each
+    batch of FETCH_SIZE rows.  If first_page is given and the rows come
+    from the database, it is called with the first batch as soon as that
+    has been fetched, so it can be shown while the rest are.
+
+    The same search run again before the database changes is answered from
+    search_cache.
+    """
+    params = dict(locals())
+    del params['con']
+    del params['progress']
+    del params['first_page']
+    close = con is None
+    if con is None:
+        con = get_con()
+    try:
+        key = search_key(params)
+        rows, generation = search_cache.get(key)
+        if rows is None:
+            rows = query_resources(con=con, progress=progress, first_page=first_page, **params)
+            search_cache.put(key, generation, rows)
+        elif progress is not None:
+            progress(len(rows))
+    finally:
+        if close:
+            con.close()
+    #the cached list mustn't change along with the caller's
+    return list(rows)
+
+
+def query_resources(name=None,exactname=None,mintl=None,orbit_zones=None,body_kinds=None,planet=None,system=None,sector=None,galaxy=None,minsecx=None,minsecy=None,minsecz=None,maxsecx=None,maxsecy=None,maxsecz=None,centerx=None,centery=None,centerz=None,radius=None,mindiameter=None,maxdiameter=None,con=None,progress=None,first_page=None):
+    """
+    Run a search_resources search, without search_cache.
+
+    Once load_resource_table has loaded a columnar.ResourceTable, the
+    search is answered from that instead, with the same results.
+    """
+    params = dict(locals())
+    del params['con']
+    del params['progress']
+    del params['first_page']
+    close = con is None
+    if con is None:
+        con = get_con()
+    try:
+        query, parameters, columnar_search = search_query(con, **params)
+
+        table = resource_table
+        if table is not None:
+            lookups, likes, bounds, centers, max_distance = columnar_search
+            matches = []
+            for column, subquery, subparameters in lookups:
+                matches.append((column, [row[0] for row in con.execute(subquery, subparameters)]))
+            rows = table.select(matches, likes, bounds, centers, max_distance)
+            if progress is not None:
+                progress(len(rows))
+            return rows
+
+        cur = con.cursor()
+        cur.row_factory = None
+        cur.execute(query, parameters)
+        rows = []
+        while True:
+            batch = cur.fetchmany(FETCH_SIZE)
+            if len(batch) == 0:
+                break
+            rows.extend(batch)
+            if first_page is not None and len(rows) == len(batch):
+                first_page(list(rows))
+            if progress is not None:
+                progress(len(rows))
+    finally:
+        if close:
+            con.close()
+
+    return rows
+
+
+#the order search results come in, as (column, direction); the last two
+#only separate rows that would otherwise tie, which paging through them
+#needs, and are left out otherwise since they make big searches slower
+SEARCH_ORDER = (
+    #resource_names ids are in alphabetical order
+    ('resource_search.name_id', 'ASC'),
+    ('resource_search.quality', 'DESC'),
+    ('resource_search.prevalence', 'DESC'),
+    ('resource_search.sector_name', 'ASC'),
+    ('resource_search.system_name', 'ASC'),
+    ('resource_search.body_name', 'ASC'),
+    ('zone_numbers.zone', 'ASC'),
+    ('resource_search.zone', 'ASC'),
+    ('resource_search.resource_id', 'ASC'),
+    )
+
+def after_key(key):
+    """
+    Return an SQL condition and its parameters for the rows that come after key in SEARCH_ORDER.
+
+    key holds a row's values of the SEARCH_ORDER columns.  NULLs come
+    first, as they do in SQLite's ordering.
+    """
+    condition = None
+    parameters = []
+    for (column, direction), value in reversed(zip(SEARCH_ORDER, key)):
+        if direction == 'ASC' and value is None:
+            later = ("%s IS NOT NULL" % column, [])
+        elif direction == 'ASC':
+            later = ("%s > ?" % column, [value])
+        elif value is None:
+            later = ("0", [])
+        else:
+            later = ("(%s < ? OR %s IS NULL)" % (column, column), [value])
+        if condition is None:
+            condition = later[0]
+            parameters = later[1]
+        else:
+            condition = "(%s OR (%s IS ? AND %s))" % (later[0], column, condition)
+            parameters = later[1] + [value] + parameters
+    if key[0] is not None:
+        #lets the primary key skip straight to the right resource name
+        condition = "%s >= ? AND %s" % (SEARCH_ORDER[0][0], condition)
+        parameters = [key[0]] + parameters
+    return condition, parameters
+
+
+def search_query(con, name=None,exactname=None,mintl=None,orbit_zones=None,body_kinds=None,planet=None,system=None,sector=None,galaxy=None,minsecx=None,minsecy=None,minsecz=None,maxsecx=None,maxsecy=None,maxsecz=None,centerx=None,centery=None,centerz=None,radius=None,mindiameter=None,maxdiameter=None,after=None,limit=None,keyed=False,count=False):
+    """
+    Build the query for a search_resources search on con.
+
+    Returns the query, its parameters, and the same search for a
+    columnar.ResourceTable as (lookups, likes, bounds, centers, max_distance).
+    The query's rows are the values of RESULT_KEYS, followed by their
+    values of the SEARCH_ORDER columns if keyed.  If after is given only
+    the rows after that key are included, and limit caps how many.  If
+    count is True, the query counts the rows instead.
+    """
+    #the distance is only known for radius searches; it is squared here and rooted in decorate
+    distance = "NULL"
+    distance_parameters = []
+    location_bounds = []
+    centers = []
+    if is_number(radius):
+        #the search fields are in sectors, which are 10 parsecs across
+        radius = float(radius) * 10
+        terms = []
+        for axis, center in (('x', centerx), ('y', centery), ('z', centerz)):
+            if is_number(center):
+                center = float(center) * 10
+                terms.append("(resource_search.%s - ?)*(resource_search.%s - ?)" % (axis, axis))
+                distance_parameters.extend([center, center])
+                centers.append((axis, center))
+                location_bounds.append(("min_%s <= ?" % axis, center + radius))
+                location_bounds.append(("max_%s >= ?" % axis, center - radius))
+        if len(terms) > 0:
+            distance = " + ".join(terms)
+
+    #body-wide resources are stored once, and zone_numbers expands them into
+    #each zone of their body; CROSS JOIN keeps
+    #resource_search as the outer loop, so its order still serves the ORDER BY
+    columns = """resource_names.name,
+                      tl,
+                      quality,
+                      prevalence,
+                      diameter,
+                      body_kinds.name,
+                      orbit_zones.name,
+                      zone_numbers.zone,
+                      galaxy_name,
+                      sector_name,
+                      system_name,
+                      system_id,
+                      body_name,
+                      %s""" % distance
+    query = """SELECT %s
+               FROM resource_search
+               CROSS JOIN zone_numbers ON zone_numbers.zone BETWEEN resource_search.zone AND resource_search.last_zone
+               LEFT JOIN resource_names ON resource_names.id = resource_search.name_id
+               LEFT JOIN body_kinds ON body_kinds.id = resource_search.body_kind_id
+               LEFT JOIN orbit_zones ON orbit_zones.id = resource_search.orbit_zone_id
                """
+    if count:
+        columns = "count(*)"
+    elif keyed:
+        columns += ", " + ", ".join([column for column, direction in SEARCH_ORDER])
+    query = query % columns
     conditions = []
     parameters = []
+    if not count:
+        parameters.extend(distance_parameters)
+    #the same search for a columnar.ResourceTable:  lookups of ids, LIKE
+    #patterns, and bounds on number columns
+    likes = []
+    bounds = []
     if is_int(mintl):
-        conditions.append("resources.tl >= ?")
-        parameters.append(mintl)
+        conditions.append("resource_search.tl >= ?")
+        parameters.append(int(mintl))
+        bounds.append(('tl', '>=', float(mintl)))
+    #names, body kinds and orbit zones are matched in their lookup tables, and then by id
+    lookups = []
+    by_name = (name != None and name != '') or (exactname != None and exactname != '')
     if name != None and name != '':
         name = "%%%s%%" % name
-        conditions.append("resources.name like ?")
-        parameters.append(name)
+        lookups.append(('name_id', "SELECT id FROM resource_names WHERE name like ?", [name]))
     if exactname != None and exactname != '':
-        conditions.append("resources.name like ?")
-        parameters.append(exactname)
+        if '%' in exactname or '_' in exactname:
+            lookups.append(('name_id', "SELECT id FROM resource_names WHERE name like ?", [exactname]))
+        else:
+            lookups.append(('name_id', "SELECT id FROM resource_names WHERE name = ? collate nocase", [exactname]))
     if type(orbit_zones) is list and len(orbit_zones) > 0:
-        conditions.append("bodies.orbit_zone in (?%s)" % (",?"*(len(orbit_zones)-1)))
-        parameters.extend(orbit_zones)
+        lookups.append(('orbit_zone_id', "SELECT id FROM orbit_zones WHERE name in (?%s)" % (",?"*(len(orbit_zones)-1)), orbit_zones))
     if type(body_kinds) is list and len(body_kinds) > 0:
+        kind_parameters = []
         if 'Ringworld' in body_kinds:
             #Ringworlds actually have the body_kind 'Ringworld Arc #'.  I need to change that when I add versioning and database migration.  Meanwhile, just work around it.
             if len(body_kinds) == 1:
-                conditions.append("bodies.body_kind like 'Ringworld%'")
+                kinds = "name like 'Ringworld%'"
             else:
-                body_kinds.remove('Ringworld')
-                conditions.append("(bodies.body_kind in (?%s) OR bodies.body_kind like 'Ringworld%%')" % (",?"*(len(body_kinds)-1)))
-                parameters.extend(body_kinds)
+                kind_parameters = [kind for kind in body_kinds if kind != 'Ringworld']
+                kinds = "name in (?%s) OR name like 'Ringworld%%'" % (",?"*(len(kind_parameters)-1))
         else:
-            conditions.append("bodies.body_kind in (?%s)" % (",?"*(len(body_kinds)-1)))
-            parameters.extend(body_kinds)
+            kinds = "name in (?%s)" % (",?"*(len(body_kinds)-1))
+            kind_parameters = body_kinds
+        lookups.append(('body_kind_id', "SELECT id FROM body_kinds WHERE %s" % kinds, kind_parameters))
+    for column, subquery, subparameters in lookups:
+        conditions.append("resource_search.%s IN (%s)" % (column, subquery))
+        parameters.extend(subparameters)
+    def add_substring_filter(column, value, index, index_column, rowid):
+        pattern = "%%%s%%" % value
+        conditions.append("%s like ?" % column)
+        parameters.append(pattern)
+        likes.append((column.split('.')[1], pattern))
+        #the trigram index needs at least three characters to narrow things down;
+        #like is still applied to the column itself, so the results are unchanged
+        if len(value) >= 3 and has_table(con, index):
+            conditions.append("%s IN (SELECT rowid FROM %s WHERE %s like ?)" % (rowid, index, index_column))
+            parameters.append(pattern)
     if planet != None and planet != '':
-        planet = "%%%s%%" % planet
-        conditions.append("bodies.name like ?")
-        parameters.append(planet)
+        add_substring_filter("resource_search.body_name", planet, 'body_names', 'name', "resource_search.body_id")
     if system != None and system != '':
-        system = "%%%s%%" % system
-        conditions.append("surveys.system_name like ?")
-        parameters.append(system)
+        add_substring_filter("resource_search.system_name", system, 'survey_names', 'system_name', "resource_search.survey_id")
     if sector != None and sector != '':
-        sector = "%%%s%%" % sector
-        conditions.append("surveys.sector_name like ?")
-        parameters.append(sector)
+        add_substring_filter("resource_search.sector_name", sector, 'survey_names', 'sector_name', "resource_search.survey_id")
     if galaxy != None and galaxy != '':
         galaxy = "%%%s%%" % galaxy
-        conditions.append("surveys.galaxy_name like ?")
+        conditions.append("resource_search.galaxy_name like ?")
         parameters.append(galaxy)
+        likes.append(('galaxy_name', galaxy))
     if is_int(minsecx):
-        conditions.append("surveys.sector_x >= ?")
+        conditions.append("resource_search.sector_x >= ?")
         parameters.append(minsecx)
+        bounds.append(('sector_x', '>=', float(minsecx)))
     if is_int(minsecy):
-        conditions.append("surveys.sector_y >= ?")
+        conditions.append("resource_search.sector_y >= ?")
         parameters.append(minsecy)
+        bounds.append(('sector_y', '>=', float(minsecy)))
     if is_int(minsecz):
-        conditions.append("surveys.sector_z >= ?")
+        conditions.append("resource_search.sector_z >= ?")
         parameters.append(minsecz)
+        bounds.append(('sector_z', '>=', float(minsecz)))
     if is_int(maxsecx):
-        conditions.append("surveys.sector_x <= ?")
+        conditions.append("resource_search.sector_x <= ?")
         parameters.append(maxsecx)
+        bounds.append(('sector_x', '<=', float(maxsecx)))
     if is_int(maxsecy):
-        conditions.append("surveys.sector_y <= ?")
+        conditions.append("resource_search.sector_y <= ?")
         parameters.append(maxsecy)
+        bounds.append(('sector_y', '<=', float(maxsecy)))
     if is_int(maxsecz):
-        conditions.append("surveys.sector_z <= ?")
+        conditions.append("resource_search.sector_z <= ?")
         parameters.append(maxsecz)
-    if is_int(radius):
-        radius = int(radius)
-        if is_int(centerx):
-            conditions.append("surveys.sector_x <= ?")
-            conditions.append("surveys.sector_x >= ?")
-            parameters.append(int(centerx)+radius)
-            parameters.append(int(centerx)-radius)
-        if is_int(centery):
-            conditions.append("surveys.sector_y <= ?")
-            conditions.append("surveys.sector_y >= ?")
-            parameters.append(int(centery)+radius)
-            parameters.append(int(centery)-radius)
-        if is_int(centerz):
-            conditions.append("surveys.sector_z <= ?")
-            conditions.append("surveys.sector_z >= ?")
-            parameters.append(int(centerz)+radius)
-            parameters.append(int(centerz)-radius)
-
-    query += "WHERE " + " AND ".join(conditions) + " "
-
-    orders = []
-    orders.append('resources.name ASC')
-    orders.append('resources.quality DESC')
-    orders.append('resources.prevalence DESC')
-    orders.append('surveys.sector_name ASC')
-    orders.append('surveys.system_name ASC')
-    orders.append('bodies.name ASC')
-    orders.append('resources.zone ASC')
-
-    query += "ORDER BY " + ", ".join(orders)
-
-    con = get_con()
-    cur = con.cursor()
-    cur.execute(query, parameters)
-    rows = cur.fetchall()
-    con.close()
-
-    ret = format_as_assoc(rows, (
-                'Resource',
-                'TL',
-                'Qual',
-                'Freq',
-                'Diameter',
-                'Kind',
-                'Type',
-                'Zone',
-                'Galaxy',
-                'Sector',
-                'System',
-                'Coords',
-                'World',
-                ))
-
-    return(ret)
+        bounds.append(('sector_z', '<=', float(maxsecz)))
+    diameter_bounds = []
+    if diameter_bound(mindiameter) is not None:
+        diameter_bounds.append(('>=', diameter_bound(mindiameter)))
+    if diameter_bound(maxdiameter) is not None:
+        diameter_bounds.append(('<=', diameter_bound(maxdiameter)))
+    if len(diameter_bounds) > 0:
+        conditions.extend(["resource_search.diameter %s ?" % b[0] for b in diameter_bounds])
+        parameters.extend([b[1] for b in diameter_bounds])
+        bounds.extend([('diameter', b[0], b[1]) for b in diameter_bounds])
+        #use the index on bodies to narrow things down to the bodies in range;
+        #a name is narrower already, since resource_search is clustered by it
+        if not by_name:
+            conditions.append("resource_search.body_id IN (SELECT ROWID FROM bodies WHERE %s)" % " AND ".join(["diameter %s ?" % b[0] for b in diameter_bounds]))
+            parameters.extend([b[1] for b in diameter_bounds])
+
+    if distance != "NULL":
+        conditions.append("%s <= ?" % distance)
+        parameters.extend(distance_parameters)
+        parameters.append(radius*radius)
+
+    if len(location_bounds) > 0 and has_table(con, 'survey_locations'):
+        #use the R*Tree to narrow things down to a bounding box before the exact test
+        conditions.append("resource_search.survey_id IN (SELECT id FROM survey_locations WHERE %s)" % " AND ".join([b[0] for b in location_bounds]))
+        parameters.extend([b[1] for b in location_bounds])
+
+    max_distance = None
+    if distance != "NULL":
+        max_distance = radius*radius
+    columnar_search = (lookups, likes, bounds, centers, max_distance)
+
+    if after is not None:
+        condition, after_parameters = after_key(after)
+        conditions.append(condition)
+        parameters.extend(after_parameters)
+
+    if len(conditions) > 0:
+        query += "WHERE " + " AND ".join(conditions) + " "
+
+    if keyed:
+        query += "ORDER BY " + ", ".join(["%s %s" % order for order in SEARCH_ORDER])
+    elif not count:
+        query += "ORDER BY " + ", ".join(["%s %s" % order for order in SEARCH_ORDER[:-2]])
+    if limit is not None:
+        query += " LIMIT ?"
+        parameters.append(limit)
+
+    return query, parameters, columnar_search
+
+
+def diameter_bound(value):
+    """Return a minimum or maximum diameter search parameter in metres, or None if it isn't one."""
+    if isinstance(value, basestring):
+        if value.strip() == '':
+            return None
+        return survey.parse_diameter(value)
+    if is_number(value):
+        return float(value)
+    return None
+
+
+def format_diameter(metres):
+    """Format a diameter in metres for display, in kilometres once it's large enough."""
+    if metres >= 1000000:
+        return '%s km' % format(int(round(metres / 1000.0)), ',')
+    return '%s m' % format(int(round(metres)), ',')
 
 
 def format_as_assoc(rows, keys):
@@ -456,44 +2409,60 @@ def format_as_assoc(rows, keys):
     return ret
 
 
+def decorate_value(key, value):
+    """
+        Decorate a single query result value by converting to string, adding % signs, etc.
+
+        This also increments a 'Zone' value so it indexes from 1 instead of 0.
+    """
+    if key == 'TL':
+        return 'TL%02d' % int(value)
+    elif key == 'Qual':
+        return 'Q%03d' % int(value)
+    elif key == 'Freq':
+        return '%03d%%' % int(value)
+    elif key == 'Zone':
+        return str(value+1)
+    elif key == 'Diameter':
+        if value is not None:
+            return format_diameter(value)
+        return ''
+    elif key == 'Type':
+        if value:
+            return value[:value.rfind(' Zone')]
+        return ''
+    elif key == 'Distance':
+        if value is not None:
+            return '%.1f' % math.sqrt(value)
+        return ''
+    return value
+
+
 def decorate(rows):
     """
         Decorate query results by converting to string, adding % signs, etc.
 
         This also increments the 'Zone' field so it indexes from 1 instead of 0.
     """
-    for index,row in enumerate(rows):
-        rows[index]['TL'] = 'TL%02d' % int(row['TL'])
-        rows[index]['Qual'] = 'Q%03d' % int(row['Qual'])
-        rows[index]['Freq'] = '%03d%%' % int(row['Freq'])
-        rows[index]['Zone'] = str(row['Zone']+1)
-        if row['Type']:
-            rows[index]['Type'] = row['Type'][:row['Type'].rfind(' Zone')]
-        else:
-            rows[index]['Type'] = ''
+    for row in rows:
+        for key in ('TL', 'Qual', 'Freq', 'Zone', 'Diameter', 'Type', 'Distance'):
+            row[key] = decorate_value(key, row.get(key))
     return rows
 
 
-def format_as_dict(rows):
-    """Format query results into a dictionary of tuples that ResultListCtrl can handle."""
-    ret = {}
-    for index,row in enumerate(decorate(rows)):
-        ret[index] = (
-                row['Resource'],
-                row['TL'],
-                row['Qual'],
-                row['Freq'],
-                row['Diameter'],
-                row['Kind'],
-                row['Type'],
-                row['Zone'],
-                row['World'],
-                row['System'],
-                row['Sector'],
-                row['Galaxy'],
-                row['Coords'],
-                )
-    return ret
+def display_pages(page_size, **kwargs):
+    """
+    Print the resources matching parameters to console in tables of page_size rows.
+
+    Each table is printed as soon as its rows have been read.  Takes the
+    same parameters as search_resources.
+    """
+    rows = iter_resources(**kwargs)
+    while True:
+        page = [row for row, key in itertools.islice(rows, page_size)]
+        if len(page) == 0:
+            break
+        display_rows(format_as_assoc(page, RESULT_KEYS))
 
 
 def display_rows(rows):
@@ -515,3 +2484,8 @@ def display_rows(rows):
                 'Coords',
                 ))
 
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
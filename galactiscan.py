@@ -23,12 +23,21 @@ import datetime
 import os.path
 import sys
 import wx
+import multiprocessing
 
 import version
 import survey
 import data
 import gui
 
+def show_resources(page_size, **params):
+    """Print the resources matching params, page_size rows at a time unless that is None."""
+    if page_size is None:
+        data.display_rows(data.find_resources(**params))
+    else:
+        data.display_pages(page_size, **params)
+
+
 def usage(ret = 0):
     print """%s <options> [file1 [file2..]]
 If neither options nor file parameters are given, open the gui.
@@ -38,92 +47,115 @@ Options:
     -h, --help              shows this message
     -v, --version           shows version number
     --clear-db              deletes the database
+    --rebuild-search        rebuilds the search table from the stored surveys
+    --compact-db            compresses the stored starmap files and shrinks the database
+    -j, --jobs <n>          parses files using n worker processes
     --tl <tl> [name]        shows resources >= tl, optionally matching name
     --name <name> [tl]      shows resources matching name, optionally >= tl
     --planet <name> [tl]    shows resources on planet named 'name', optionally >= tl
     --system <name> [tl]    shows resources on system named 'name', optionally >= tl
+    --min-diameter <d>      limits the searches after it to bodies at least d across,
+                            in metres or with a unit like '5 km'
+    --max-diameter <d>      limits the searches after it to bodies at most d across
+    --page-size <n>         prints the results of the searches after it n rows at a
+                            time, starting as soon as the first n have been found
 """ % (version.name)
     exit(ret)
 
 
-gs = wx.App()
-gs.SetAppName(version.name)
-
-files = []
-
-if len(sys.argv) > 1:
-    i = 1
-    while i < len(sys.argv):
-        if sys.argv[i] == '-h' or sys.argv[i] == '--help':
-            usage()
-        elif sys.argv[i] == '-v' or sys.argv[i] == '--version':
-            print version.string
-        elif sys.argv[i] == '--clear-db':
-            if len(sys.argv) == 2:
-                data.drop_tables()
-            else:
-                print "Error: The --clear-db option must not be used with other options, else operator error is assumed."
-                exit(1)
-        elif sys.argv[i] == '--tl' and len(sys.argv) > i+1:
-            if len(sys.argv) > i+2:
-                rows = data.find_resources(name=sys.argv[i+2], mintl=sys.argv[i+1])
-                i+=2
-            else:
-                rows = data.find_resources(mintl=sys.argv[i+1])
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    gs = wx.App()
+    gs.SetAppName(version.name)
+
+    files = []
+    jobs = 1
+    #extra parameters for the searches
+    filters = {}
+    #rows per table when printing search results, or None for one table
+    page_size = None
+
+    if len(sys.argv) > 1:
+        i = 1
+        while i < len(sys.argv):
+            if sys.argv[i] == '-h' or sys.argv[i] == '--help':
+                usage()
+            elif sys.argv[i] == '-v' or sys.argv[i] == '--version':
+                print version.string
+            elif sys.argv[i] == '--clear-db':
+                if len(sys.argv) == 2:
+                    data.drop_tables()
+                else:
+                    print "Error: The --clear-db option must not be used with other options, else operator error is assumed."
+                    exit(1)
+            elif sys.argv[i] == '--tl' and len(sys.argv) > i+1:
+                if len(sys.argv) > i+2:
+                    show_resources(page_size, name=sys.argv[i+2], mintl=sys.argv[i+1], **filters)
+                    i+=2
+                else:
+                    show_resources(page_size, mintl=sys.argv[i+1], **filters)
+                    i+=1
+                exit(0)
+            elif sys.argv[i] == '--name' and len(sys.argv) > i+1:
+                if len(sys.argv) > i+2:
+                    show_resources(page_size, name=sys.argv[i+1], mintl=sys.argv[i+2], **filters)
+                    i+=2
+                else:
+                    show_resources(page_size, name=sys.argv[i+1], **filters)
+                    i+=1
+                exit(0)
+            elif sys.argv[i] == '--planet' and len(sys.argv) > i+1:
+                if len(sys.argv) > i+2:
+                    show_resources(page_size, planet=sys.argv[i+1], mintl=sys.argv[i+2], **filters)
+                    i+=2
+                else:
+                    show_resources(page_size, planet=sys.argv[i+1], **filters)
+                    i+=1
+                exit(0)
+            elif sys.argv[i] == '--system' and len(sys.argv) > i+1:
+                if len(sys.argv) > i+2:
+                    show_resources(page_size, system=sys.argv[i+1], mintl=sys.argv[i+2], **filters)
+                    i+=2
+                else:
+                    show_resources(page_size, system=sys.argv[i+1], **filters)
+                    i+=1
+                exit(0)
+            elif sys.argv[i] == '--min-diameter' and len(sys.argv) > i+1:
+                filters['mindiameter'] = sys.argv[i+1]
                 i+=1
-            data.display_rows(rows)
-            exit(0)
-        elif sys.argv[i] == '--name' and len(sys.argv) > i+1:
-            if len(sys.argv) > i+2:
-                rows = data.find_resources(name=sys.argv[i+1], mintl=sys.argv[i+2])
-                i+=2
-            else:
-                rows = data.find_resources(name=sys.argv[i+1])
+            elif sys.argv[i] == '--max-diameter' and len(sys.argv) > i+1:
+                filters['maxdiameter'] = sys.argv[i+1]
                 i+=1
-            data.display_rows(rows)
-            exit(0)
-        elif sys.argv[i] == '--planet' and len(sys.argv) > i+1:
-            if len(sys.argv) > i+2:
-                rows = data.find_resources(planet=sys.argv[i+1], mintl=sys.argv[i+2])
-                i+=2
-            else:
-                rows = data.find_resources(planet=sys.argv[i+1])
+            elif sys.argv[i] == '--page-size' and len(sys.argv) > i+1:
+                if not data.is_int(sys.argv[i+1]) or int(sys.argv[i+1]) < 1:
+                    print "Error: The --page-size option requires a positive number of rows."
+                    exit(1)
+                page_size = int(sys.argv[i+1])
                 i+=1
-            data.display_rows(rows)
-            exit(0)
-        elif sys.argv[i] == '--system' and len(sys.argv) > i+1:
-            if len(sys.argv) > i+2:
-                rows = data.find_resources(system=sys.argv[i+1], mintl=sys.argv[i+2])
-                i+=2
-            else:
-                rows = data.find_resources(system=sys.argv[i+1])
+            elif sys.argv[i] == '--rebuild-search':
+                data.rebuild_search_table()
+            elif sys.argv[i] == '--compact-db':
+                count = data.compress_raws()
+                print "%d stored files compressed" % count
+            elif (sys.argv[i] == '-j' or sys.argv[i] == '--jobs') and len(sys.argv) > i+1:
+                if not data.is_int(sys.argv[i+1]) or int(sys.argv[i+1]) < 1:
+                    print "Error: The --jobs option requires a positive number of jobs."
+                    exit(1)
+                jobs = int(sys.argv[i+1])
                 i+=1
-            data.display_rows(rows)
-            exit(0)
-        elif os.path.isfile(sys.argv[i]):
-            files.append(sys.argv[i])
-        else:
-            print "unknown argument: %s" % sys.argv[i]
-            usage(1)
-        i+=1
-
-    #add any files that were specified
-    if len(files) > 0:
-        data.add_files(files)
-
-else:
-    gui.main()
-    gs.MainLoop()
-
-
-
-
-
-
-
-
-
-
+            elif os.path.isfile(sys.argv[i]):
+                files.append(sys.argv[i])
+            else:
+                print "unknown argument: %s" % sys.argv[i]
+                usage(1)
+            i+=1
 
+        #add any files that were specified
+        if len(files) > 0:
+            data.add_files(files, jobs)
 
+    else:
+        gui.main()
+        gs.MainLoop()
 
@@ -4,14 +4,15 @@
 import sqlite3
 import datetime
 import os.path
-import sys
+import time
+import threading
 import wx
 from wx.lib.mixins.listctrl import ListCtrlAutoWidthMixin
-from wx.lib.mixins.listctrl import ColumnSorterMixin
 
 import version
 import survey
 import data
+import columnar
 import about
 
 
@@ -38,77 +39,87 @@ galaxy_names = [
     "Edge of the Rift",
     ]
 
-orbit_zones = [
-    'Inferno Zone',
-    'Inner Zone',
-    'Habitable Zone',
-    'Outer Zone',
-    'Frigid Zone',
-    ]
-
-body_kinds = [
-    'Ringworld',
-    'Planet',
-    'Large Moon',
-    'Moon',
-    'Ring',
-    'Gas Giant',
-    'Star',
-    ]
-
 
 class AutoWidthListCtrl(wx.ListCtrl, ListCtrlAutoWidthMixin):
-    def __init__(self, parent):
-        wx.ListCtrl.__init__(self, parent, wx.ID_ANY, style=wx.LC_REPORT)
+    def __init__(self, parent, style=wx.LC_REPORT):
+        wx.ListCtrl.__init__(self, parent, wx.ID_ANY, style=style)
         ListCtrlAutoWidthMixin.__init__(self)
 
 
-class SortedListCtrl(AutoWidthListCtrl, ColumnSorterMixin):
-    def __init__(self, parent, data):
-        AutoWidthListCtrl.__init__(self, parent)
-        ColumnSorterMixin.__init__(self, len(data.values()[0]))
-        self.itemDataMap = data
 
-    def GetListCtrl(self):
-        return self
 
+class ResultListCtrl(AutoWidthListCtrl):
+    """
+    Virtual list of search results.
 
+    The rows are kept as the undecorated tuples from data.search_resources,
+    and each cell is only formatted when the control asks to draw it.
+    Sorting reorders a list of row indices rather than the control itself.
+    """
 
+    #the columns, as (heading, alignment, width, index into a data.RESULT_KEYS row)
+    columns = (
+        ('name',     wx.LIST_FORMAT_LEFT,  140, data.RESULT_KEYS.index('Resource')),
+        ('tl',       wx.LIST_FORMAT_RIGHT,  50, data.RESULT_KEYS.index('TL')),
+        ('quality',  wx.LIST_FORMAT_RIGHT,  60, data.RESULT_KEYS.index('Qual')),
+        ('prev',     wx.LIST_FORMAT_RIGHT,  60, data.RESULT_KEYS.index('Freq')),
+        ('diameter', wx.LIST_FORMAT_RIGHT,  80, data.RESULT_KEYS.index('Diameter')),
+        ('kind',     wx.LIST_FORMAT_LEFT,   80, data.RESULT_KEYS.index('Kind')),
+        ('type',     wx.LIST_FORMAT_LEFT,   80, data.RESULT_KEYS.index('Type')),
+        ('zone',     wx.LIST_FORMAT_LEFT,   50, data.RESULT_KEYS.index('Zone')),
+        ('world',    wx.LIST_FORMAT_LEFT,  140, data.RESULT_KEYS.index('World')),
+        ('system',   wx.LIST_FORMAT_LEFT,  140, data.RESULT_KEYS.index('System')),
+        ('sector',   wx.LIST_FORMAT_LEFT,  140, data.RESULT_KEYS.index('Sector')),
+        ('galaxy',   wx.LIST_FORMAT_LEFT,  140, data.RESULT_KEYS.index('Galaxy')),
+        ('coords',   wx.LIST_FORMAT_LEFT,   80, data.RESULT_KEYS.index('Coords')),
+        ('distance', wx.LIST_FORMAT_RIGHT,  70, data.RESULT_KEYS.index('Distance')),
+        )
 
-class ResultListCtrl(SortedListCtrl):
-    def __init__(self, parent, data):
-        SortedListCtrl.__init__(self, parent, data)
+    def __init__(self, parent):
+        AutoWidthListCtrl.__init__(self, parent, style=wx.LC_REPORT|wx.LC_VIRTUAL)
 
         #build the columns
-        self.InsertColumn(0, 'name', width=140)
-        self.InsertColumn(1, 'tl', wx.LIST_FORMAT_RIGHT, 50)
-        self.InsertColumn(2, 'quality', wx.LIST_FORMAT_RIGHT, 60)
-        self.InsertColumn(3, 'prev', wx.LIST_FORMAT_RIGHT, 60)
-        self.InsertColumn(4, 'diameter', width=80)
-        self.InsertColumn(5, 'kind', width=80)
-        self.InsertColumn(6, 'type', width=80)
-        self.InsertColumn(7, 'zone', width=50)
-        self.InsertColumn(8, 'world', width=140)
-        self.InsertColumn(9, 'system', width=140)
-        self.InsertColumn(10, 'sector', width=140)
-        self.InsertColumn(11, 'galaxy', width=140)
-        self.InsertColumn(12, 'coords', width=80)
-
-        #insert the data
-        self.InsertData(data)
-
-    def InsertData(self, data):
-        items = data.items()
-        for key, i in items:
-            index = self.InsertStringItem(sys.maxint, i[0])
-            for k in range(1, len(i)):
-                self.SetStringItem(index, k, i[k])
-            self.SetItemData(index, key)
-
-    def SetData(self, data):
-        self.DeleteAllItems()
-        self.InsertData(data)
-        self.itemDataMap = data
+        for col, (heading, align, width, index) in enumerate(self.columns):
+            self.InsertColumn(col, heading, align, width)
+
+        self.rows = []
+        self.order = []
+        self.sort_column = None
+        self.sort_ascending = True
+
+        self.Bind(wx.EVT_LIST_COL_CLICK, self.OnColClick)
+
+    def SetRows(self, rows):
+        """Show a new list of rows from data.search_resources, keeping the current sort."""
+        self.rows = rows
+        self.order = range(len(rows))
+        if self.sort_column is not None:
+            self.SortRows()
+        self.SetItemCount(len(rows))
+        self.Refresh()
+
+    def SortRows(self):
+        """Reorder the row indices by the values in the sort column."""
+        index = self.columns[self.sort_column][3]
+        values = [row[index] for row in self.rows]
+        self.order.sort(key=values.__getitem__, reverse=not self.sort_ascending)
+
+    def OnColClick(self, e):
+        col = e.GetColumn()
+        if col == self.sort_column:
+            self.sort_ascending = not self.sort_ascending
+        else:
+            self.sort_column = col
+            self.sort_ascending = True
+        self.SortRows()
+        self.Refresh()
+
+    def OnGetItemText(self, item, col):
+        index = self.columns[col][3]
+        value = data.decorate_value(data.RESULT_KEYS[index], self.rows[self.order[item]][index])
+        if value is None:
+            return ''
+        return unicode(value)
 
 
 
@@ -119,14 +130,29 @@ class Menubar(wx.MenuBar):
         fileMenu = wx.Menu()
         helpMenu = wx.Menu()
 
+        #the items that change the database, see EnableDatabaseItems
+        self.database_items = []
+
         fitem = fileMenu.Append(wx.ID_OPEN, 'Define DB', 'Define Database')
         parent.Bind(wx.EVT_MENU, parent.DefineDatabase, fitem)
+        self.database_items.append(fitem)
 
         fitem = fileMenu.Append(wx.ID_REDO, 'Reprocess DB', 'Reprocess Database')
         parent.Bind(wx.EVT_MENU, parent.ReprocessDatabase, fitem)
+        self.database_items.append(fitem)
+
+        fitem = fileMenu.Append(wx.ID_ANY, 'Compact DB', 'Compress stored starmaps and shrink the database')
+        parent.Bind(wx.EVT_MENU, parent.CompactDatabase, fitem)
+        self.database_items.append(fitem)
 
         fitem = fileMenu.Append(wx.ID_CLEAR, 'Clear DB', 'Clear database')
         parent.Bind(wx.EVT_MENU, parent.ClearDatabase, fitem)
+        self.database_items.append(fitem)
+
+        fitem = fileMenu.AppendCheckItem(wx.ID_ANY, 'Search in Memory', 'Keep a copy of the resources in memory for faster searches (needs NumPy)')
+        fitem.Check(data.get_columnar_enabled())
+        fitem.Enable(columnar.available())
+        parent.Bind(wx.EVT_MENU, parent.ToggleColumnar, fitem)
 
         fitem = fileMenu.Append(wx.ID_EXIT, 'Quit', 'Quit application')
         parent.Bind(wx.EVT_MENU, parent.OnQuit, fitem)
@@ -138,6 +164,11 @@ class Menubar(wx.MenuBar):
         self.Append(helpMenu, '&Help')
         parent.SetMenuBar(self)
 
+    def EnableDatabaseItems(self, enable):
+        """Enable or disable the items that change the database."""
+        for item in self.database_items:
+            item.Enable(enable)
+
 
 
 class Toolbar(wx.BoxSizer):
@@ -159,68 +190,20 @@ class SearchControls(wx.BoxSizer):
     def __init__(self, parent, grandparent):
         wx.BoxSizer.__init__(self, wx.HORIZONTAL)
 
-        resources = [
-            'Air',
-            'Animal Carcass',
-            'Antiflux Particles',
-            'Beans',
-            'Bolite',
-            'Borexino Precipitate',
-            'Cheese',
-            'Coal',
-            'Cryozine',
-            'Crystals',
-            'Eggs',
-            'Eludium',
-            'Fertilizer',
-            'Fish',
-            'Fruit',
-            'Gems',
-            'Grain',
-            'Grapes',
-            'Herbs',
-            'Hops',
-            'Hydrogen',
-            'Ice',
-            'Ioplasma',
-            'Log',
-            'Lumenite',
-            'Magmex',
-            'Milk',
-            'Minerals',
-            'Myrathane',
-            'Natural Gas',
-            'Nuts',
-            'Oil',
-            'Ore',
-            'Phlogiston',
-            'Plant Fiber',
-            'Polytaride',
-            'Radioactives',
-            'Spices',
-            'Stone',
-            'Sunlight',
-            'Type A Preons',
-            'Type B Preons',
-            'Type F Preons',
-            'Type G Preons',
-            'Type K Preons',
-            'Type M Preons',
-            'Type O Preons',
-            'Vegetable',
-            'Vegetation Density',
-            'Vulcanite',
-            'Water in the Environment',
-            ]
 
         name_l = wx.StaticText(parent, label="Name:")
-        self.name_field = wx.ComboBox(parent, style=wx.TE_PROCESS_ENTER, choices=resources)
+        self.name_field = wx.ComboBox(parent, style=wx.TE_PROCESS_ENTER)
         tl_l = wx.StaticText(parent, label="Min TL:")
         self.tl_field = wx.TextCtrl(parent, style=wx.TE_PROCESS_ENTER)
+        mindiameter_l = wx.StaticText(parent, label="Min Diam:")
+        self.mindiameter_field = wx.TextCtrl(parent, style=wx.TE_PROCESS_ENTER)
+        maxdiameter_l = wx.StaticText(parent, label="Max Diam:")
+        self.maxdiameter_field = wx.TextCtrl(parent, style=wx.TE_PROCESS_ENTER)
         galaxy_l = wx.StaticText(parent, label="Galaxy:")
         self.galaxy_field = wx.ComboBox(parent, style=wx.TE_PROCESS_ENTER, choices=galaxy_names)
-        self.orbit_field = wx.ListBox(parent, style=wx.LB_EXTENDED, choices=orbit_zones)
-        self.body_field = wx.ListBox(parent, style=wx.LB_EXTENDED, choices=body_kinds)
+        self.orbit_field = wx.ListBox(parent, style=wx.LB_EXTENDED)
+        self.body_field = wx.ListBox(parent, style=wx.LB_EXTENDED)
+        self.LoadChoices()
         planet_l = wx.StaticText(parent, label="Planet:")
         self.planet_field = wx.TextCtrl(parent, style=wx.TE_PROCESS_ENTER)
         system_l = wx.StaticText(parent, label="System:")
@@ -244,6 +227,7 @@ class SearchControls(wx.BoxSizer):
 
         self.reset_button = wx.Button(parent, id=wx.ID_CLEAR)
         self.search_button = wx.Button(parent, id=wx.ID_FIND)
+        self.cancel_button = wx.Button(parent, id=wx.ID_CANCEL)
 
         vbox_l = wx.BoxSizer(wx.VERTICAL)
         vbox_r = wx.BoxSizer(wx.VERTICAL)
@@ -285,6 +269,10 @@ class SearchControls(wx.BoxSizer):
         hbox1.Add(self.name_field,   proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
         hbox1.Add(tl_l,              proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
         hbox1.Add(self.tl_field,     proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
+        hbox1.Add(mindiameter_l,     proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
+        hbox1.Add(self.mindiameter_field, proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
+        hbox1.Add(maxdiameter_l,     proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
+        hbox1.Add(self.maxdiameter_field, proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
         hbox1.Add(galaxy_l,          proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
         hbox1.Add(self.galaxy_field, proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
 
@@ -316,6 +304,7 @@ class SearchControls(wx.BoxSizer):
 
         hbox_buttons.Add(self.reset_button,  proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
         hbox_buttons.Add(self.search_button, proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
+        hbox_buttons.Add(self.cancel_button, proportion=0, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT, border=5)
 
         hbox_bodies.Add(self.orbit_field,  proportion=1, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT|wx.EXPAND, border=5)
         hbox_bodies.Add(self.body_field,  proportion=1, flag=wx.ALIGN_CENTER|wx.LEFT|wx.RIGHT|wx.EXPAND, border=5)
@@ -323,8 +312,11 @@ class SearchControls(wx.BoxSizer):
         #bind the search controls
         grandparent.Bind(wx.EVT_BUTTON, self.OnReset,  id=self.reset_button.GetId())
         grandparent.Bind(wx.EVT_BUTTON, grandparent.OnSearch, id=self.search_button.GetId())
+        grandparent.Bind(wx.EVT_BUTTON, grandparent.OnCancelSearch, id=self.cancel_button.GetId())
         grandparent.Bind(wx.EVT_TEXT_ENTER, grandparent.OnSearch, id=self.name_field.GetId())
         grandparent.Bind(wx.EVT_TEXT_ENTER, grandparent.OnSearch, id=self.tl_field.GetId())
+        grandparent.Bind(wx.EVT_TEXT_ENTER, grandparent.OnSearch, id=self.mindiameter_field.GetId())
+        grandparent.Bind(wx.EVT_TEXT_ENTER, grandparent.OnSearch, id=self.maxdiameter_field.GetId())
         grandparent.Bind(wx.EVT_TEXT_ENTER, grandparent.OnSearch, id=self.galaxy_field.GetId())
         grandparent.Bind(wx.EVT_TEXT_ENTER, grandparent.OnSearch, id=self.planet_field.GetId())
         grandparent.Bind(wx.EVT_TEXT_ENTER, grandparent.OnSearch, id=self.system_field.GetId())
@@ -340,9 +332,22 @@ class SearchControls(wx.BoxSizer):
         grandparent.Bind(wx.EVT_TEXT_ENTER, grandparent.OnSearch, id=self.centerz_field.GetId())
         grandparent.Bind(wx.EVT_TEXT_ENTER, grandparent.OnSearch, id=self.radius_field.GetId())
 
+    def LoadChoices(self):
+        """Fill the resource, orbit zone and body kind choices from the database."""
+        self.resources = data.get_resource_names()
+        self.orbit_zones = data.get_orbit_zones()
+        self.body_kinds = data.get_body_kinds()
+        name = self.name_field.GetValue()
+        self.name_field.SetItems(self.resources)
+        self.name_field.SetValue(name)
+        self.orbit_field.Set(self.orbit_zones)
+        self.body_field.Set(self.body_kinds)
+
     def OnReset(self, e):
         self.name_field.SetValue("")
         self.tl_field.SetValue("")
+        self.mindiameter_field.SetValue("")
+        self.maxdiameter_field.SetValue("")
         self.galaxy_field.SetValue("")
         self.orbit_field.SetSelection(wx.NOT_FOUND)
         self.body_field.SetSelection(wx.NOT_FOUND)
@@ -362,6 +367,162 @@ class SearchControls(wx.BoxSizer):
 
 
 
+class SearchThread(threading.Thread):
+    """
+    Runs data.search_resources in the background on its own connection.
+
+    The first batch of rows is handed to frame.OnSearchPage as soon as it is
+    fetched, and all of them to frame.OnSearchDone at the end, both through
+    wx.CallAfter.
+    """
+    def __init__(self, frame, params):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frame = frame
+        self.params = params
+        self.con = None
+        self.cancelled = False
+        self.count = 0
+        self.start_time = time.time()
+
+    def run(self):
+        rows = None
+        error = None
+        try:
+            self.con = data.get_con()
+            #sqlite calls this every so often, and gives up if it returns True
+            self.con.set_progress_handler(self.IsCancelled, 10000)
+            rows = data.search_resources(con=self.con, progress=self.SetCount, first_page=self.ShowFirstPage, **self.params)
+        except sqlite3.Error as e:
+            if not self.cancelled:
+                error = e
+        except Exception as e:
+            #anything else would leave the frame waiting on this search forever
+            error = e
+        finally:
+            con = self.con
+            #the connection goes back to the pool, so a late Cancel mustn't reach it
+            self.con = None
+            if con is not None:
+                con.close()
+        wx.CallAfter(self.frame.OnSearchDone, self, rows, error)
+
+    def IsCancelled(self):
+        return self.cancelled
+
+    def SetCount(self, count):
+        self.count = count
+
+    def ShowFirstPage(self, rows):
+        wx.CallAfter(self.frame.OnSearchPage, self, rows)
+
+    def Elapsed(self):
+        return time.time() - self.start_time
+
+    def Cancel(self):
+        self.cancelled = True
+        try:
+            self.con.interrupt()
+        except (AttributeError, sqlite3.ProgrammingError):
+            #not connected yet, or already finished
+            pass
+
+
+
+class ResourceTableThread(threading.Thread):
+    """
+    Runs data.load_resource_table in the background.
+
+    Searches read the database directly until it is done.  The outcome is
+    shown in frame's status bar.
+    """
+    def __init__(self, frame):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frame = frame
+
+    def run(self):
+        start = time.time()
+        try:
+            table = data.load_resource_table()
+            if table is None:
+                return
+            message = "%d resources loaded into memory (%.1f seconds)" % (len(table), time.time() - start)
+        except sqlite3.Error as e:
+            message = "Failed to load resources into memory: %s" % e
+        wx.CallAfter(self.frame.status.SetStatusText, message)
+
+
+
+class CompactThread(threading.Thread):
+    """
+    Runs data.compress_raws in the background.
+
+    The outcome is handed back to frame.OnCompactDone through wx.CallAfter.
+    """
+    def __init__(self, frame):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frame = frame
+
+    def run(self):
+        count = None
+        error = None
+        try:
+            count = data.compress_raws()
+        except Exception as e:
+            error = e
+        wx.CallAfter(self.frame.OnCompactDone, count, error)
+
+
+
+class IngestThread(threading.Thread):
+    """
+    Runs data.add_files or data.add_files_from_internal_raws in the background.
+
+    The latest data.IngestProgress is kept in self.progress for the GUI to
+    show, and the outcome is handed back to frame.OnIngestDone through
+    wx.CallAfter.
+    """
+    def __init__(self, frame, function, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frame = frame
+        self.function = function
+        self.args = args
+        self.progress = None
+        self.cancelled = False
+
+    def run(self):
+        count = None
+        error = None
+        try:
+            count = self.function(*self.args, progress=self.SetProgress)
+        except data.Cancelled:
+            pass
+        except Exception as e:
+            error = e
+        wx.CallAfter(self.frame.OnIngestDone, self, count, error)
+
+    def SetProgress(self, progress):
+        self.progress = progress
+        return not self.cancelled
+
+    def Cancel(self):
+        self.cancelled = True
+
+
+
+def format_duration(seconds):
+    """Format a number of seconds as h:mm:ss or m:ss."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
+
+
+
 class Galactiscan(wx.Frame):
     def __init__(self, *args, **kwargs):
         super(Galactiscan, self).__init__(*args, **kwargs)
@@ -369,10 +530,10 @@ class Galactiscan(wx.Frame):
         self.InitUI()
 
     def OnSearch(self, e):
-        self.status.SetStatusText("Searching...")
-
         name = self.search_controls.name_field.GetValue()
         tl = self.search_controls.tl_field.GetValue()
+        mindiameter = self.search_controls.mindiameter_field.GetValue()
+        maxdiameter = self.search_controls.maxdiameter_field.GetValue()
         galaxy = self.search_controls.galaxy_field.GetValue()
         planet = self.search_controls.planet_field.GetValue()
         system = self.search_controls.system_field.GetValue()
@@ -394,19 +555,52 @@ class Galactiscan(wx.Frame):
                 ret.append(l[i])
             return ret
 
-        orbits = values_from_indices(orbit_zones, self.search_controls.orbit_field.GetSelections())
-        bodies = values_from_indices(body_kinds, self.search_controls.body_field.GetSelections())
+        orbits = values_from_indices(self.search_controls.orbit_zones, self.search_controls.orbit_field.GetSelections())
+        bodies = values_from_indices(self.search_controls.body_kinds, self.search_controls.body_field.GetSelections())
+
+        if name+tl+mindiameter+maxdiameter+planet+system+sector != '':
+            #only the newest search matters
+            if self.search is not None:
+                self.search.Cancel()
+
+            self.status.SetStatusText("Searching...")
+            self.search = SearchThread(self, dict(exactname=name, mintl=tl, orbit_zones=orbits, body_kinds=bodies,
+                                                  planet=planet, system=system, sector=sector, galaxy=galaxy,
+                                                  minsecx=minsecx, minsecy=minsecy, minsecz=minsecz,
+                                                  maxsecx=maxsecx, maxsecy=maxsecy, maxsecz=maxsecz,
+                                                  centerx=centerx, centery=centery, centerz=centerz,
+                                                  radius=radius,
+                                                  mindiameter=mindiameter, maxdiameter=maxdiameter,
+                                                 ))
+            self.search.start()
+            self.search_timer.Start(250)
+
+    def OnSearchTimer(self, e):
+        if self.search is not None:
+            self.status.SetStatusText("Searching... %d resources so far (%.1f seconds)" % (self.search.count, self.search.Elapsed()))
+
+    def OnSearchPage(self, search, rows):
+        if search is self.search:
+            self.list.SetRows(rows)
+
+    def OnSearchDone(self, search, rows, error):
+        if search is not self.search:
+            #this one was replaced by a newer search
+            return
+        self.search = None
+        self.search_timer.Stop()
+        if rows is not None:
+            self.list.SetRows(rows)
+            hits, misses = data.search_cache.statistics()
+            self.status.SetStatusText("%d resources found (%.2f seconds; %d of %d searches answered from cache)" % (len(rows), search.Elapsed(), hits, hits + misses))
+        elif error is not None:
+            self.status.SetStatusText("Search failed: %s" % error)
+        else:
+            self.status.SetStatusText("Search cancelled after %.1f seconds" % search.Elapsed())
 
-        if name+tl+planet+system+sector != '':
-            rows = data.find_resources(exactname=name, mintl=tl, orbit_zones=orbits, body_kinds=bodies,
-                                       planet=planet, system=system, sector=sector, galaxy=galaxy,
-                                       minsecx=minsecx, minsecy=minsecy, minsecz=minsecz,
-                                       maxsecx=maxsecx, maxsecy=maxsecy, maxsecz=maxsecz,
-                                       centerx=centerx, centery=centery, centerz=centerz,
-                                       radius=radius,
-                                      )
-            self.list.SetData(data.format_as_dict(rows))
-            self.status.SetStatusText("%d resources found" % len(rows))
+    def OnCancelSearch(self, e):
+        if self.search is not None:
+            self.search.Cancel()
 
     def DefineDatabase(self, e):
         last_path = os.path.abspath(data.get_database_path())
@@ -420,7 +614,9 @@ class Galactiscan(wx.Frame):
         if dialog.ShowModal() == wx.ID_OK:
             path = dialog.GetPath()
             data.set_database_path(path)
+            self.search_controls.LoadChoices()
             self.status.SetStatusText("Database set to %s" % path)
+            self.LoadResourceTable()
         else:
             self.status.SetStatusText("Database unchanged (%s)" % last_path)
 
@@ -437,23 +633,97 @@ class Galactiscan(wx.Frame):
             paths = dialog.GetPaths()
             data.set_last_starmap_path(paths[-1])
             self.status.SetStatusText("Now processing %s files..." % len(paths))
-            count = data.add_files(paths)
-            self.status.SetStatusText("%s surveys added" % count)
+            self.StartIngest("Adding files", "Cancelled; only the files already finished were added", data.add_files, paths)
         else:
             self.status.SetStatusText("No surveys added")
 
     def ReprocessDatabase(self, e):
-        #TODO:  This is very slow; make it asynchronous and add a progress meter.
         self.status.SetStatusText("Reprocessing database...")
-        count = data.add_files_from_internal_raws()
-        if count > 0:
-            self.status.SetStatusText("%s surveys added" % count)
+        self.StartIngest("Reprocessing database", "Reprocessing paused; Reprocess DB again to continue",
+                         data.add_files_from_internal_raws)
+
+    def StartIngest(self, title, cancelled_message, function, *args):
+        self.ingest = IngestThread(self, function, *args)
+        self.ingest_cancelled_message = cancelled_message
+        #the dialog is sized to its first message, so give it as many lines as the later ones
+        self.ingest_dialog = wx.ProgressDialog(title, "Starting...\n\n\n", maximum=1000, parent=self,
+                                               style=wx.PD_APP_MODAL|wx.PD_CAN_ABORT|wx.PD_ELAPSED_TIME)
+        self.ingest.start()
+        self.ingest_timer.Start(250)
+
+    def OnIngestTimer(self, e):
+        progress = self.ingest.progress
+        if progress is None:
+            message = "Starting...\n\n\n"
+        else:
+            eta = progress.eta()
+            message = "File %d of %d\n" % (min(progress.files+1, progress.total_files), progress.total_files)
+            message += "%d surveys, %d rows\n" % (progress.systems, progress.rows)
+            message += "%.1f of %.1f MB (%.0f surveys/sec, %.2f MB/sec)\n" % (progress.bytes/1e6, progress.total_bytes/1e6,
+                                                                          progress.systems/progress.elapsed(),
+                                                                          progress.bytes/1e6/progress.elapsed())
+            if eta is not None:
+                message += "About %s remaining" % format_duration(eta)
+        if self.ingest.cancelled:
+            message = "Cancelling...\n\n\n"
+        value = 0
+        if progress is not None:
+            value = int(progress.fraction() * 1000)
+        result = self.ingest_dialog.Update(min(value, 999), message)
+        #newer wxPython returns (continue, skip)
+        if isinstance(result, tuple):
+            result = result[0]
+        if not result:
+            self.ingest.Cancel()
+
+    def OnIngestDone(self, ingest, count, error):
+        self.ingest_timer.Stop()
+        self.ingest_dialog.Destroy()
+        self.ingest = None
+        #the files may have brought new names with them
+        self.search_controls.LoadChoices()
+        if error is not None:
+            self.status.SetStatusText("Failed to add surveys: %s" % error)
+        elif count is None:
+            self.status.SetStatusText(self.ingest_cancelled_message)
+        elif count > 0:
+            self.status.SetStatusText("%s surveys added in %s" % (count, format_duration(ingest.progress.elapsed())))
         else:
             self.status.SetStatusText("No surveys added")
 
+    def CompactDatabase(self, e):
+        self.status.SetStatusText("Compacting database...")
+        #searches can go on meanwhile, but nothing else may change the database
+        self.EnableDatabaseControls(False)
+        CompactThread(self).start()
+
+    def OnCompactDone(self, count, error):
+        self.EnableDatabaseControls(True)
+        if error is not None:
+            self.status.SetStatusText("Failed to compact database: %s" % error)
+        else:
+            self.status.SetStatusText("%d stored files compressed" % count)
+
+    def EnableDatabaseControls(self, enable):
+        self.menubar.EnableDatabaseItems(enable)
+        self.toolbar.add_button.Enable(enable)
+
+    def ToggleColumnar(self, e):
+        data.set_columnar_enabled(e.IsChecked())
+        if e.IsChecked():
+            self.LoadResourceTable()
+        else:
+            self.status.SetStatusText("Searches read the database directly")
+
+    def LoadResourceTable(self):
+        if data.get_columnar_enabled():
+            self.status.SetStatusText("Loading resources into memory...")
+            ResourceTableThread(self).start()
+
     def ClearDatabase(self, e):
         self.status.SetStatusText("Clearing database...")
         data.drop_tables()
+        self.search_controls.LoadChoices()
         self.status.SetStatusText("Database cleared")
 
     #def OnPaste(self, e):
@@ -489,6 +759,17 @@ class Galactiscan(wx.Frame):
 
     def InitUI(self):
         self.SetTitle(version.fancy_name)
+
+        #the search running in the background, if any
+        self.search = None
+        data.configure_search_cache()
+        self.search_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnSearchTimer, self.search_timer)
+
+        #the file ingest running in the background, if any
+        self.ingest = None
+        self.ingest_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnIngestTimer, self.ingest_timer)
         if wx.Config.Get().HasEntry('/window/width'):
             size = (wx.Config.Get().ReadInt('/window/width'), wx.Config.Get().ReadInt('/window/height'))
         else:
@@ -517,10 +798,7 @@ class Galactiscan(wx.Frame):
 
 
         #the main viewing area
-        stuff = {
-            0 : ('', '', '', '', '', '', '', '', '', '', '', '', ''),
-            }
-        self.list = ResultListCtrl(panel, stuff)
+        self.list = ResultListCtrl(panel)
         main_vbox.Add(self.list, proportion=1, flag=wx.EXPAND)
 
 
@@ -539,6 +817,8 @@ class Galactiscan(wx.Frame):
 
         self.Show(True)
 
+        self.LoadResourceTable()
+
     def OnQuit(self, e):
         self.Close()
 
@@ -4,14 +4,20 @@ import math
 import datetime
 import StringIO
 import re
+import hashlib
+import zlib
 import xml.etree.ElementTree as ET
 
 
-class System:
-    location = None
-    galaxy = None
+#the model classes use __slots__, since a galaxy holds millions of them
+
+class System(object):
+    __slots__ = ('location', 'galaxy', 'fingerprint', 'wormholes', 'bodies')
 
     def __init__(self):
+        self.location = None
+        self.galaxy = None
+        self.fingerprint = None
         self.wormholes = []
         self.bodies = []
 
@@ -23,20 +29,26 @@ class System:
             ret += '\n' + str(b)
         return ret
 
-class Body:
-    name = None
-    body_kind = None
-    star_type = None
-    spectral_class = None
-    star_size = None
-    diameter = None
-    orbits = None
-    orbit_distance = None
-    orbit_zone = None
+class Body(object):
+    __slots__ = ('name', 'body_kind', 'star_type', 'spectral_class', 'star_size', 'diameter',
+                 'orbits', 'orbit_distance', 'orbit_zone', 'satellites', 'zones',
+                 'body_wide', 'body_wide_zones')
 
     def __init__(self):
+        self.name = None
+        self.body_kind = None
+        self.star_type = None
+        self.spectral_class = None
+        self.star_size = None
+        self.diameter = None
+        self.orbits = None
+        self.orbit_distance = None
+        self.orbit_zone = None
         self.satellites = []
         self.zones = []
+        #the global resources are kept once, along with how many zones they reach
+        self.body_wide = []
+        self.body_wide_zones = 0
 
     def __repr__(self):
         return "<Body name: %s>" % self.name
@@ -55,7 +67,8 @@ class Body:
 
         for i in range(len(self.zones)):
             ret += "Zone %s:\n" % i
-            ret += str(self.zones[i])
+            for r in self.zone_resources(i):
+                ret += str(r) + "\n"
 
         return ret
 
@@ -66,16 +79,23 @@ class Body:
         #warning: make sure all zones are created before this is used, or only zone 1 will be populated
         if len(self.zones) == 0:
             self.zones.append(Zone())
-        for z in self.zones:
-            z.add_resource(r)
+        self.body_wide.append(r)
+        self.body_wide_zones = len(self.zones)
     def add_zone_resource(self, z, r):
         #add zones as needed
         while len(self.zones) <= z:
             self.zones.append(Zone())
         self.zones[z].add_resource(r)
+    def zone_resources(self, z):
+        """Returns the resources in zone z, including the global ones that reach it."""
+        if z < self.body_wide_zones:
+            return self.body_wide + self.zones[z].resources
+        return self.zones[z].resources
+
 
+class Zone(object):
+    __slots__ = ('resources',)
 
-class Zone:
     def __init__(self):
         self.resources = []
 
@@ -89,7 +109,15 @@ class Zone:
         self.resources.append(r)
 
 
-class Resource:
+class Resource(object):
+    """
+    A resource with its quality and prevalence.
+
+    Resources are never modified once made, so use get_resource, which
+    hands out one shared instance for each distinct resource in a starmap.
+    """
+    __slots__ = ('name', 'quality', 'prevalence', 'tl')
+
     def __init__(self, name, quality, prevalence):
         self.name = name
         self.quality = int(quality)
@@ -103,7 +131,60 @@ class Resource:
         return "%s Q%s %s%% (TL%s)" % (self.name, self.quality, self.prevalence, self.tl)
 
 
-class Wormhole:
+class SystemRows(object):
+    """
+    A surveyed system as the rows it is stored as, without the object graph.
+
+    'survey' is the surveys row, without its ROWID or stored_date.
+    'wormholes' holds (polarity, source_id, dest_id) rows.  'bodies' holds
+    (name, body_kind, star_type, spectral_class, star_size, diameter,
+    orbits, orbit_zone, num_zones) rows, with the diameter in metres.
+    'resources' holds (name, quality, prevalence, tl, zone, body_index)
+    rows, where body_index is the position of the body in 'bodies'.  A zone
+    of None means the resource is found in every zone of the body, and is
+    stored just once.
+    """
+    __slots__ = ('system_id', 'fingerprint', 'survey', 'wormholes', 'bodies', 'resources')
+
+    def __init__(self, location, galaxy_name, fingerprint):
+        self.system_id = str(location.universal_coords)
+        self.fingerprint = fingerprint
+        self.survey = (
+                location.system_coords.x, location.system_coords.y, location.system_coords.z,
+                location.system_name, self.system_id,
+                location.sector_coords.x, location.sector_coords.y, location.sector_coords.z,
+                location.sector_name, str(location.sector_coords),
+                galaxy_name,
+                fingerprint,
+                location.universal_coords.x, location.universal_coords.y, location.universal_coords.z,
+                )
+        self.wormholes = []
+        self.bodies = []
+        self.resources = []
+
+    def add_body(self, body, zones, body_wide=(), body_wide_zones=0):
+        """
+        Add a body row, and resource rows from zones and body_wide.
+
+        zones is a list with a list of (name, quality, prevalence, tl) tuples
+        for each zone of the body.  body_wide is a list of the same tuples
+        for the global resources, which reach the first body_wide_zones
+        zones.  Those are stored once for the whole body when they reach
+        every zone, and copied into the zones they reach otherwise.
+        """
+        body_index = len(self.bodies)
+        self.bodies.append(body + (len(zones),))
+        if body_wide_zones >= len(zones):
+            self.resources.extend([r + (None, body_index) for r in body_wide])
+        else:
+            zones = [list(body_wide) + zones[z] for z in range(body_wide_zones)] + zones[body_wide_zones:]
+        for z in range(len(zones)):
+            self.resources.extend([r + (z, body_index) for r in zones[z]])
+
+
+class Wormhole(object):
+    __slots__ = ('polarity', 'source', 'dest')
+
     def __repr__(self):
         #return "<Wormhole %s from %s to %s>" % (self.polarity, self.source.system_name, self.dest.system_name)
         return "<Wormhole %s from %s to %s>" % (self.polarity, self.source, self.dest)
@@ -112,8 +193,10 @@ class Wormhole:
         return "%s wormhole from %s to %s" % (self.polarity, self.source, self.dest)
 
 
-class Location:
+class Location(object):
     """Contains names and coordinates of system and sector."""
+    __slots__ = ('universal_coords', 'sector_coords', 'system_coords', 'system_name', 'sector_name')
+
     def __init__(self, sys_node, sec_node):
         self.universal_coords = Coords(sys_node) #pc
         self.sector_coords = Coords(sec_node) #deca-pc
@@ -128,8 +211,10 @@ class Location:
         return "%s (%s) in %s (%s)" % (self.system_name, self.system_coords, self.sector_name, self.sector_coords)
 
 
-class LocalCoords:
+class LocalCoords(object):
     """Local coordinates in parsecs, relative to sector center."""
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, universal, sector):
         self.x = universal.x - sector.x*10
         self.y = universal.y - sector.y*10
@@ -142,8 +227,10 @@ class LocalCoords:
         return "%s %s %s" % (self.x, self.y, self.z)
 
 
-class Coords:
+class Coords(object):
     """Contains xyz coordinates."""
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, node):
         if 'x' in node.keys():
             self.x = float(node.get('x'))
@@ -162,6 +249,72 @@ class Coords:
         return "%s %s %s" % (self.x, self.y, self.z)
 
 
+class ZlibReader:
+    """
+    Read-only file handler that decompresses a zlib buffer as it is read.
+
+    tell() gives the position in the compressed buffer rather than in the
+    decompressed data, so progress can be measured against the stored size.
+    """
+    chunk_size = 64*1024
+
+    def __init__(self, compressed):
+        self.compressed = compressed
+        self.pos = 0
+        self.decompressor = zlib.decompressobj()
+        self.closed = False
+
+    def read(self, size=-1):
+        pieces = []
+        length = 0
+        while size < 0 or length < size:
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.unconsumed_tail
+            elif self.pos < len(self.compressed):
+                data = self.compressed[self.pos:self.pos+self.chunk_size]
+                self.pos += len(data)
+            else:
+                pieces.append(self.decompressor.flush())
+                break
+            #a max_length of 0 means no limit
+            piece = self.decompressor.decompress(data, max(size - length, 0))
+            pieces.append(piece)
+            length += len(piece)
+        return ''.join(pieces)
+
+    def tell(self):
+        return self.pos - len(self.decompressor.unconsumed_tail)
+
+    def close(self):
+        self.closed = True
+
+
+def intern_name(name):
+    """Returns the interned copy of name, for names that repeat throughout a starmap."""
+    if isinstance(name, str):
+        return intern(name)
+    return name
+
+#the most shared resources a cache holds before it is emptied, so one huge starmap can't grow it forever
+RESOURCE_CACHE_SIZE = 200000
+
+def get_resource(name, quality, prevalence, cache):
+    """
+    Returns the shared Resource for the given name, quality and prevalence.
+
+    cache is a dictionary of the Resources made so far, by (name, quality,
+    prevalence) as found in the XML.  Each parse keeps its own, so they are
+    freed along with the parse.
+    """
+    key = (name, quality, prevalence)
+    r = cache.get(key)
+    if r is None:
+        if len(cache) >= RESOURCE_CACHE_SIZE:
+            cache.clear()
+        r = cache[key] = Resource(intern_name(name), quality, prevalence)
+    return r
+
+
 def is_starmap_file(filename):
     """Return True if 'filename' is a starmap file."""
     if filename is not None:
@@ -174,75 +327,288 @@ def is_starmap_file(filename):
 def process_starmap_file(filename):
     """Processes starmap file 'filename'."""
     if filename is not None:
-        f = open(filename, 'rb')
-        return process_starmap_fh(f)
+        return list(iter_starmap_file(filename))
 
-def process_starmap_buffer(starmap):
-    """Processes raw starmap buffer 'starmap'."""
+def process_starmap_buffer(starmap, codec=None):
+    """Processes raw starmap buffer 'starmap', compressed with 'codec' if given."""
     if starmap is not None:
-        f = StringIO.StringIO(starmap)
-        return process_starmap_fh(f)
+        return list(iter_starmap_buffer(starmap, codec=codec))
 
 def process_starmap_fh(f):
     """Processes starmap that file handler 'f' points at."""
-    raw = f.read()
-    f.close()
-    root = ET.fromstring(raw)
-
-    systems = []
-
-    for galaxy in root.findall('galaxy'):
-        #TODO: add galaxy support
-        for sector in galaxy.findall('sector'):
-            for system in sector.findall('system[@eod="Surveyed"]'):
-                systems.append(System())
-                systems[-1].location = Location(system, sector)
-                systems[-1].galaxy = galaxy.get('name')
-                for wormhole in system.findall('wormhole'):
-                    systems[-1].wormholes.append(Wormhole())
-                    systems[-1].wormholes[-1].polarity = wormhole.get('polarity')
-                    systems[-1].wormholes[-1].source = systems[-1].location
-                    systems[-1].wormholes[-1].dest = systems[-1].location
-                for star in system.findall('star'):
-                    systems[-1].bodies.append(Body())
-                    systems[-1].bodies[-1].name = star.get('name')
-                    systems[-1].bodies[-1].body_kind = 'Star'
-                    systems[-1].bodies[-1].star_type = star.get('name')[0]
-                    systems[-1].bodies[-1].spectral_class = star.get('spectralClass')
-                    systems[-1].bodies[-1].star_size = star.get('size')
-                    systems[-1].bodies[-1].diameter = star.get('diameter').split()[0]
-                    if 'orbit' in star.keys():
-                        systems[-1].bodies[-1].orbits = star.get('orbit')
-                    systems[-1].bodies[-1].set_zones(1)
-                    for resource in star.findall('resource'):
-                        systems[-1].bodies[-1].add_global_resource(Resource(resource.get('name'), resource.get('quality'), resource.get('abundance')))
-                for planet in system.findall('planet'):
-                    systems[-1].bodies.append(Body())
-                    systems[-1].bodies[-1].name = planet.get('name')
-                    systems[-1].bodies[-1].body_kind = planet.get('bodyType')
-                    systems[-1].bodies[-1].orbits = planet.get('orbit')
-                    systems[-1].bodies[-1].orbit_zone = planet.get('zone')
-                    for geosphere in planet.findall('geosphere'):
-                        diameter = geosphere.get('diameter')
-                        if diameter.split()[-1] == 'Diameter':
-                            systems[-1].bodies[-1].diameter = diameter.split()[0]
-                        else:
-                            systems[-1].bodies[-1].diameter = str(int(diameter.split()[0].strip('Lm').replace(',',''))*2)+'m'
-                        num_zones = int(geosphere.get('resourceZones'))
-                        for resource in geosphere.findall('resource'):
-                            for z in range(1,num_zones+1):
-                                systems[-1].bodies[-1].add_zone_resource(z-1, Resource(resource.get('name'), resource.get('qualityZone%s' % z), resource.get('abundanceZone%s' % z)))
-                    for hydrosphere in planet.findall('hydrosphere'):
-                        for resource in hydrosphere.findall('resource'):
-                            systems[-1].bodies[-1].add_global_resource(Resource(resource.get('name'), resource.get('qualityZone1'), resource.get('abundanceZone1')))
-                    for atmosphere in planet.findall('atmosphere'):
-                        for resource in atmosphere.findall('resource'):
-                            systems[-1].bodies[-1].add_global_resource(Resource(resource.get('name'), resource.get('qualityZone1'), resource.get('abundanceZone1')))
-                    for biosphere in planet.findall('biosphere'):
-                        for resource in biosphere.findall('resource'):
-                            for z in range(1,num_zones+1):
-                                systems[-1].bodies[-1].add_zone_resource(z-1, Resource(resource.get('name'), resource.get('qualityZone%s' % z), resource.get('abundanceZone%s' % z)))
-
-    return systems
+    return list(iter_starmap_fh(f))
+
+def iter_starmap_file(filename, skip=None):
+    """Iterates over the surveyed systems in starmap file 'filename'."""
+    if filename is not None:
+        f = open(filename, 'rb')
+        return iter_starmap_fh(f, skip)
+    return iter([])
+
+def iter_starmap_buffer(starmap, skip=None, codec=None):
+    """Iterates over the surveyed systems in raw starmap buffer 'starmap', compressed with 'codec' if given."""
+    if starmap is not None:
+        return iter_starmap_fh(open_starmap_buffer(starmap, codec), skip)
+    return iter([])
+
+def open_starmap_buffer(starmap, codec=None):
+    """
+    Returns a file handler reading raw starmap buffer 'starmap'.
+
+    'codec' is None for plain XML, or 'zlib', in which case the buffer is
+    decompressed a piece at a time as it is read.
+    """
+    if codec is None:
+        return StringIO.StringIO(starmap)
+    elif codec == 'zlib':
+        return ZlibReader(starmap)
+    raise ValueError("unknown starmap codec: %s" % codec)
+
+def iter_starmap_fh(f, skip=None):
+    """
+    Iterates over the surveyed systems in the starmap that file handler 'f' points at.
+
+    This is a generator built on iterparse:  each System is yielded as soon as
+    its <system> element closes, and finished elements are dropped from the
+    tree, so memory use depends on the size of one system rather than the
+    whole galaxy.  The file handler is closed once the generator finishes.
+
+    Each System is given the fingerprint of its XML.  If 'skip' is given, it
+    is called with the fingerprint first, and if it returns True the system
+    is passed over without being built.
+    """
+    cache = {}
+    for node, sector, galaxy_name, fingerprint in iter_system_nodes(f, skip):
+        s = process_system_node(node, sector, galaxy_name, cache)
+        s.fingerprint = fingerprint
+        yield s
+
+def iter_starmap_rows(f, skip=None):
+    """
+    Iterates over the surveyed systems in the starmap that file handler 'f' points at, as SystemRows.
+
+    This works like iter_starmap_fh, but goes straight to the rows that get
+    stored, without building the System/Body/Zone/Resource objects.
+    """
+    cache = {}
+    for node, sector, galaxy_name, fingerprint in iter_system_nodes(f, skip):
+        yield process_system_node_rows(node, sector, galaxy_name, fingerprint, cache)
+
+def iter_starmap_file_rows(filename, skip=None):
+    """Iterates over the surveyed systems in starmap file 'filename', as SystemRows."""
+    if filename is not None:
+        return iter_starmap_rows(open(filename, 'rb'), skip)
+    return iter([])
+
+def iter_system_nodes(f, skip=None):
+    """
+    Iterates over the surveyed <system> elements in the starmap that file handler 'f' points at.
+
+    Yields tuples of the <system> element, its <sector> element, the galaxy
+    name and the fingerprint.  The elements are cleared once the next item
+    is asked for, so use them before then.
+    """
+    try:
+        #track the open elements, so we only accept galaxy/sector/system nesting
+        stack = []
+        for event, node in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                stack.append(node)
+                continue
+
+            stack.pop()
+            tags = [n.tag for n in stack[1:]]
+            if node.tag == 'system' and tags == ['galaxy', 'sector']:
+                if node.get('eod') == 'Surveyed':
+                    fingerprint = system_fingerprint(node, stack[2], stack[1].get('name'))
+                    if skip is None or not skip(fingerprint):
+                        yield (node, stack[2], stack[1].get('name'), fingerprint)
+            elif not (node.tag == 'sector' and tags == ['galaxy']):
+                continue
+
+            #we're done with this element, so get rid of it
+            node.clear()
+            stack[-1].remove(node)
+    finally:
+        f.close()
+
+def system_fingerprint(system, sector, galaxy_name):
+    """
+    Returns a digest of a <system> element, along with its sector and galaxy.
+
+    Whitespace between elements is ignored, so the same survey exported
+    twice gives the same fingerprint.
+    """
+    for node in system.iter():
+        if node.text is not None and node.text.strip() == '':
+            node.text = None
+        node.tail = None
+    digest = hashlib.sha1()
+    for name in (galaxy_name, sector.get('name'), sector.get('x'), sector.get('y'), sector.get('z')):
+        digest.update(unicode(name).encode('utf-8') + '\0')
+    digest.update(ET.tostring(system))
+    return digest.hexdigest()
+
+def process_system_node(system, sector, galaxy_name, cache=None):
+    """
+    Builds a System from a <system> element and its parent <sector> element.
+
+    cache is the get_resource cache to share Resources through, if any.
+    """
+    if cache is None:
+        cache = {}
+    s = System()
+    s.location = Location(system, sector)
+    s.galaxy = galaxy_name
+    for wormhole in system.findall('wormhole'):
+        s.wormholes.append(Wormhole())
+        s.wormholes[-1].polarity = wormhole.get('polarity')
+        s.wormholes[-1].source = s.location
+        s.wormholes[-1].dest = s.location
+    for star in system.findall('star'):
+        s.bodies.append(Body())
+        s.bodies[-1].name = star.get('name')
+        s.bodies[-1].body_kind = 'Star'
+        s.bodies[-1].star_type = star.get('name')[0]
+        s.bodies[-1].spectral_class = star.get('spectralClass')
+        s.bodies[-1].star_size = star.get('size')
+        s.bodies[-1].diameter = parse_diameter(star.get('diameter'), 'km')
+        if 'orbit' in star.keys():
+            s.bodies[-1].orbits = star.get('orbit')
+        s.bodies[-1].set_zones(1)
+        for resource in star.findall('resource'):
+            s.bodies[-1].add_global_resource(get_resource(resource.get('name'), resource.get('quality'), resource.get('abundance'), cache))
+    for planet in system.findall('planet'):
+        s.bodies.append(Body())
+        s.bodies[-1].name = planet.get('name')
+        s.bodies[-1].body_kind = planet.get('bodyType')
+        s.bodies[-1].orbits = planet.get('orbit')
+        s.bodies[-1].orbit_zone = planet.get('zone')
+        for geosphere in planet.findall('geosphere'):
+            s.bodies[-1].diameter = parse_geosphere_diameter(geosphere.get('diameter'))
+            num_zones = int(geosphere.get('resourceZones'))
+            for resource in geosphere.findall('resource'):
+                for z in range(1,num_zones+1):
+                    s.bodies[-1].add_zone_resource(z-1, get_resource(resource.get('name'), resource.get('qualityZone%s' % z), resource.get('abundanceZone%s' % z), cache))
+        for hydrosphere in planet.findall('hydrosphere'):
+            for resource in hydrosphere.findall('resource'):
+                s.bodies[-1].add_global_resource(get_resource(resource.get('name'), resource.get('qualityZone1'), resource.get('abundanceZone1'), cache))
+        for atmosphere in planet.findall('atmosphere'):
+            for resource in atmosphere.findall('resource'):
+                s.bodies[-1].add_global_resource(get_resource(resource.get('name'), resource.get('qualityZone1'), resource.get('abundanceZone1'), cache))
+        for biosphere in planet.findall('biosphere'):
+            for resource in biosphere.findall('resource'):
+                for z in range(1,num_zones+1):
+                    s.bodies[-1].add_zone_resource(z-1, get_resource(resource.get('name'), resource.get('qualityZone%s' % z), resource.get('abundanceZone%s' % z), cache))
+    return s
+
+def process_system_node_rows(system, sector, galaxy_name, fingerprint, cache=None):
+    """
+    Builds the SystemRows for a <system> element and its parent <sector> element.
+
+    This must give exactly the rows that system_rows gives for the System
+    built by process_system_node.  cache is the resource_row cache to share
+    rows through, if any.
+    """
+    if cache is None:
+        cache = {}
+    location = Location(system, sector)
+    rows = SystemRows(location, galaxy_name, fingerprint)
+    system_id = rows.system_id
+    for wormhole in system.findall('wormhole'):
+        rows.wormholes.append((wormhole.get('polarity'), system_id, system_id))
+    for star in system.findall('star'):
+        body_wide = []
+        for resource in star.findall('resource'):
+            body_wide.append(resource_row(resource.get('name'), resource.get('quality'), resource.get('abundance'), cache))
+        rows.add_body((star.get('name'), 'Star', star.get('name')[0], star.get('spectralClass'), star.get('size'),
+                       parse_diameter(star.get('diameter'), 'km'), star.get('orbit'), None), [[]], body_wide, 1)
+    for planet in system.findall('planet'):
+        diameter = None
+        zones = []
+        body_wide = []
+        body_wide_zones = 0
+        for geosphere in planet.findall('geosphere'):
+            diameter = parse_geosphere_diameter(geosphere.get('diameter'))
+            num_zones = int(geosphere.get('resourceZones'))
+            for resource in geosphere.findall('resource'):
+                for z in range(1,num_zones+1):
+                    add_zone_resource(zones, z-1, resource_row(resource.get('name'), resource.get('qualityZone%s' % z), resource.get('abundanceZone%s' % z), cache))
+        for sphere in planet.findall('hydrosphere') + planet.findall('atmosphere'):
+            for resource in sphere.findall('resource'):
+                body_wide.append(resource_row(resource.get('name'), resource.get('qualityZone1'), resource.get('abundanceZone1'), cache))
+                #like Body.add_global_resource, these reach the zones made so far, or just the first
+                if len(zones) == 0:
+                    zones.append([])
+                body_wide_zones = len(zones)
+        for biosphere in planet.findall('biosphere'):
+            for resource in biosphere.findall('resource'):
+                for z in range(1,num_zones+1):
+                    add_zone_resource(zones, z-1, resource_row(resource.get('name'), resource.get('qualityZone%s' % z), resource.get('abundanceZone%s' % z), cache))
+        rows.add_body((planet.get('name'), intern_name(planet.get('bodyType')), None, None, None,
+                       diameter, planet.get('orbit'), intern_name(planet.get('zone'))), zones, body_wide, body_wide_zones)
+    return rows
+
+#metres per unit, for the units diameters are given in
+DIAMETER_UNITS = {
+    'm': 1,
+    'km': 1000,
+    }
+
+def parse_diameter(text, unit='m'):
+    """
+    Returns a diameter such as '1,392 km' or '12345 m Diameter' in metres.
+
+    unit is assumed when text doesn't give one.  Returns None if text
+    doesn't start with a number.
+    """
+    match = re.match(r'\s*L?([0-9][0-9,]*(?:\.[0-9]+)?)\s*([A-Za-z]*)', text)
+    if match is None:
+        return None
+    metres = float(match.group(1).replace(',', '')) * DIAMETER_UNITS.get(match.group(2), DIAMETER_UNITS[unit])
+    if metres == int(metres):
+        return int(metres)
+    return metres
+
+def parse_geosphere_diameter(text):
+    """Returns the diameter of a planet in metres, from the 'diameter' of its <geosphere>."""
+    if text.split()[-1] == 'Diameter':
+        return parse_diameter(text)
+    #ringworlds give their length instead, like 'L9,123m Length'
+    return parse_diameter(text) * 2
+
+def resource_row(name, quality, prevalence, cache):
+    """
+    Returns the shared (name, quality, prevalence, tl) tuple for a resource.
+
+    cache works like get_resource's, but holds these tuples.
+    """
+    key = (name, quality, prevalence)
+    r = cache.get(key)
+    if r is None:
+        if len(cache) >= RESOURCE_CACHE_SIZE:
+            cache.clear()
+        name = intern_name(name)
+        quality = int(quality)
+        r = cache[key] = (name, quality, int(prevalence), quality/8+1)
+    return r
+
+def add_zone_resource(zones, z, r):
+    """Like Body.add_zone_resource, for a list of lists of resource rows."""
+    while len(zones) <= z:
+        zones.append([])
+    zones[z].append(r)
+
+def system_rows(system):
+    """Returns the SystemRows for a System built by process_system_node."""
+    rows = SystemRows(system.location, system.galaxy, system.fingerprint)
+    for w in system.wormholes:
+        rows.wormholes.append((w.polarity, str(w.source.universal_coords), str(w.dest.universal_coords)))
+    for b in system.bodies:
+        rows.add_body((b.name, b.body_kind, b.star_type, b.spectral_class, b.star_size,
+                       b.diameter, b.orbits, b.orbit_zone),
+                      [[(r.name, r.quality, r.prevalence, r.tl) for r in z.resources] for z in b.zones],
+                      [(r.name, r.quality, r.prevalence, r.tl) for r in b.body_wide], b.body_wide_zones)
+    return rows
 
 